@@ -13,11 +13,24 @@ def register():
     from . import histopathology_wizard
     from . import immunoassay
     from . import immunoassay_wizard
+    from . import lab_station_wizard
+    from . import create_lab_test_from_workflow_wizard
+    from . import lab_test_type
+    from . import ir
+    from . import workflow_transition
+    from . import configuration
+    from . import worklist
+    from . import sample_label_report
+    from . import immunoassay_plate_import_wizard
+    from . import immunoassay_plate
+    from . import molecular_biology_qpcr_import_wizard
+    from . import histopathology_scan_wizard
     
     Pool.register(
         health_lab_workflow.GnuHealthLabWorkflowSample,
         health_lab_workflow.GnuHealthLab,
         health_lab_workflow.CreateLabWorkflowStart,
+        health_lab_workflow.CreateLabWorkflowResult,
         lab_test_request_origin.GnuHealthPatientLabTestWithOrigin,
         lab_test_request_origin.CreateLabWorkflowStartWithOrigin,
         molecular_biology.GnuHealthLabMolecularBiology,
@@ -29,10 +42,41 @@ def register():
         immunoassay.GnuHealthLabImmunoassay,
         immunoassay.GnuHealthLabImmunoassayAntibody,
         immunoassay_wizard.CreateImmunoassayStart,
+        lab_station_wizard.LabStationStart,
+        lab_station_wizard.LabStationResult,
+        create_lab_test_from_workflow_wizard.CreateLabTestFromWorkflowStart,
+        create_lab_test_from_workflow_wizard.CreateLabTestFromWorkflowResult,
+        lab_test_type.GnuHealthLabTestType,
+        lab_test_type.GnuHealthLabTestCritearea,
+        ir.Cron,
+        workflow_transition.GnuHealthLabWorkflowTransition,
+        workflow_transition.GnuHealthLabTurnaroundContext,
+        workflow_transition.GnuHealthLabTurnaround,
+        configuration.GnuHealthLabWorkflowConfiguration,
+        worklist.GnuHealthLabWorklist,
+        immunoassay_plate_import_wizard.ImmunoassayPlateImportStart,
+        immunoassay_plate_import_wizard.ImmunoassayPlateImportResult,
+        immunoassay_plate.GnuHealthLabImmunoassayPlate,
+        immunoassay_plate.GnuHealthLabImmunoassayPlateWell,
+        molecular_biology.GnuHealthLabMolecularBiologyCtRule,
+        molecular_biology_qpcr_import_wizard.MolecularBiologyQpcrImportStart,
+        molecular_biology_qpcr_import_wizard.MolecularBiologyQpcrImportResult,
+        histopathology.GnuHealthLabHistopathologyCassette,
+        histopathology.GnuHealthLabHistopathologySlide,
+        histopathology_scan_wizard.HistopathologyScanStart,
+        histopathology_scan_wizard.HistopathologyScanResult,
         module='health_lab_workflow', type_='model')
     Pool.register(
         health_lab_workflow.CreateLabWorkflowWizard,
         molecular_biology_wizard.CreateMolecularBiologyWizard,
         histopathology_wizard.CreateHistopathologyWizard,
         immunoassay_wizard.CreateImmunoassayWizard,
+        lab_station_wizard.LabStationWizard,
+        create_lab_test_from_workflow_wizard.CreateLabTestFromWorkflowWizard,
+        immunoassay_plate_import_wizard.ImmunoassayPlateImportWizard,
+        molecular_biology_qpcr_import_wizard.MolecularBiologyQpcrImportWizard,
+        histopathology_scan_wizard.HistopathologyScanWizard,
         module='health_lab_workflow', type_='wizard')
+    Pool.register(
+        sample_label_report.SampleLabelReport,
+        module='health_lab_workflow', type_='report')
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark de los caminos críticos de health_lab_workflow
+
+Genera una carga sintética de órdenes de laboratorio sobre el backend de
+pruebas de trytond (SQLite en memoria por defecto), con muestras del flujo,
+procesos de las tres especialidades y anticuerpos/marcadores, y mide las
+lecturas de listas, los botones de estado, los asistentes y la búsqueda de
+muestras listas para completar.
+
+Uso:
+
+    python benchmarks/bench_workflow.py --orders 500
+
+Para cada operación se informa operaciones por segundo y consultas SQL por
+operación, seguido del resumen de instrumentation por botón, transición y
+getter. La base de datos se toma de DB_NAME / TRYTOND_DATABASE_URI igual
+que en los tests de trytond. Los resultados representativos son los de
+PostgreSQL; en SQLite los percentiles del reporte de tiempos de respuesta
+se calculan por rango más cercano en lugar de PERCENTILE_CONT.
+"""
+
+import argparse
+import os
+import sys
+from contextlib import contextmanager
+from datetime import date
+
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.pool import Pool  # noqa: E402
+from trytond.tests.test_tryton import (  # noqa: E402
+    activate_module, DB_NAME, USER, CONTEXT)
+from trytond.transaction import Transaction  # noqa: E402
+
+MODULE = 'health_lab_workflow'
+
+
+class Benchmark(object):
+    'Acumula los resultados de cada operación medida'
+
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+        self.results = []
+
+    @contextmanager
+    def measure(self, name, ops):
+        with self.instrumentation.counting() as stats:
+            yield
+        ops = max(ops, 1)
+        self.results.append((name, ops, stats.time, stats.queries / ops))
+
+    def report(self, out=sys.stdout):
+        out.write('%-45s %8s %12s %12s\n' % (
+                'operation', 'ops', 'ops/s', 'queries/op'))
+        for name, ops, elapsed, queries in self.results:
+            out.write('%-45s %8d %12.1f %12.1f\n' % (
+                    name, ops, ops / elapsed if elapsed else float('inf'),
+                    queries))
+
+        # Detalle por botón, transición y getter instrumentados
+        out.write('\n%-60s %8s %12s %12s\n' % (
+                'instrumented call', 'calls', 'queries', 'max/call'))
+        summary = self.instrumentation.summary()
+        for name in sorted(summary):
+            entry = summary[name]
+            out.write('%-60s %8d %12d %12d\n' % (
+                    name, entry['calls'], entry['queries'],
+                    entry['max_queries']))
+
+
+def run_wizard(wiz_name, transition, model, ids, **start_values):
+    """Ejecuta la transición de un asistente sobre los registros indicados
+    con los valores dados en su estado inicial"""
+    Wizard = Pool().get(wiz_name, type='wizard')
+    with Transaction().set_context(active_model=model, active_id=ids[0],
+            active_ids=ids):
+        session_id, _, _ = Wizard.create()
+        wizard = Wizard(session_id)
+        for name, value in start_values.items():
+            setattr(wizard.start, name, value)
+        getattr(wizard, 'transition_%s' % transition)()
+        Wizard.delete(session_id)
+
+
+def generate(orders):
+    """Crea los datos maestros y las solicitudes de examen sintéticas"""
+    pool = Pool()
+    Party = pool.get('party.party')
+    Patient = pool.get('gnuhealth.patient')
+    HealthProfessional = pool.get('gnuhealth.healthprofessional')
+    TestType = pool.get('gnuhealth.lab.test_type')
+    LabTestRequest = pool.get('gnuhealth.patient.lab.test')
+
+    professional_party, = Party.create([{
+                'name': 'Bench Pathologist',
+                'is_person': True,
+                'is_healthprof': True,
+                }])
+    professional, = HealthProfessional.create([{
+                'name': professional_party.id,
+                }])
+
+    test_types = TestType.create([{
+                'name': 'Bench Test %s' % i,
+                'code': 'BENCH%s' % i,
+                'critearea': [('create', [{
+                                'name': 'Analyte %s' % j,
+                                'code': 'A%s' % j,
+                                'sequence': j,
+                                } for j in range(5)])],
+                } for i in range(3)])
+
+    parties = Party.create([{
+                'name': 'Bench Patient %s' % i,
+                'is_person': True,
+                'is_patient': True,
+                } for i in range(orders)])
+    patients = Patient.create([{'name': p.id} for p in parties])
+
+    requests = LabTestRequest.create([{
+                'name': test_types[i % len(test_types)].id,
+                'patient_id': patient.id,
+                'request': 100000 + i,
+                'state': 'draft',
+                'date': date.today(),
+                } for i, patient in enumerate(patients)])
+    return professional, requests
+
+
+def main(orders):
+    activate_module(MODULE)
+    from trytond.modules.health_lab_workflow import instrumentation
+    instrumentation.enable()
+    bench = Benchmark(instrumentation)
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        pool = Pool()
+        Sample = pool.get('gnuhealth.lab.workflow.sample')
+        Molecular = pool.get('gnuhealth.lab.molecular_biology')
+        Histopathology = pool.get('gnuhealth.lab.histopathology')
+        HistopathologyAntibody = pool.get(
+            'gnuhealth.lab.histopathology.antibody')
+        Immunoassay = pool.get('gnuhealth.lab.immunoassay')
+        ImmunoassayAntibody = pool.get('gnuhealth.lab.immunoassay.antibody')
+        Worklist = pool.get('gnuhealth.lab.workflow.worklist')
+        Turnaround = pool.get('gnuhealth.lab.workflow.turnaround')
+
+        professional, requests = generate(orders)
+        instrumentation.reset()
+
+        # Asistentes: alta de muestras y de procesos
+        with bench.measure('wizard create_lab_workflow', len(requests)):
+            run_wizard('gnuhealth.create_lab_workflow', 'create_workflow',
+                'gnuhealth.patient.lab.test', [r.id for r in requests])
+        samples = Sample.search([], order=[('id', 'ASC')])
+        numbers = '\n'.join(s.name for s in samples)
+
+        with bench.measure('wizard lab station (collect)', len(samples)):
+            run_wizard('gnuhealth.lab.workflow.station', 'apply',
+                'gnuhealth.lab.workflow.sample', [samples[0].id],
+                action='collect', scans=numbers)
+        with bench.measure('button sample receive', len(samples)):
+            Sample.receive(samples)
+
+        # Un tercio de las muestras por especialidad
+        thirds = [samples[i::3] for i in range(3)]
+        with bench.measure('wizard create_molecular_biology', len(thirds[0])):
+            for sample in thirds[0]:
+                run_wizard('gnuhealth.create_molecular_biology',
+                    'create_process', 'gnuhealth.lab.workflow.sample',
+                    [sample.id],
+                    study_type='qpcr',
+                    responsible_professional=professional)
+        with bench.measure('wizard create_histopathology', len(thirds[1])):
+            for sample in thirds[1]:
+                run_wizard('gnuhealth.create_histopathology',
+                    'create_process', 'gnuhealth.lab.workflow.sample',
+                    [sample.id],
+                    study_type='immunohistochemistry',
+                    responsible_professional=professional)
+        with bench.measure('wizard create_immunoassay', len(thirds[2])):
+            for sample in thirds[2]:
+                run_wizard('gnuhealth.create_immunoassay', 'create_process',
+                    'gnuhealth.lab.workflow.sample', [sample.id],
+                    assay_type='elisa', kit_name='Bench Kit',
+                    responsible_professional=professional)
+
+        molecular = Molecular.search([])
+        histopathology = Histopathology.search([])
+        immunoassay = Immunoassay.search([])
+        HistopathologyAntibody.create([{
+                    'histopathology': h.id,
+                    'name': 'CK%s' % i,
+                    } for h in histopathology for i in range(4)])
+        ImmunoassayAntibody.create([{
+                    'immunoassay': t.id,
+                    'name': 'IgG%s' % i,
+                    } for t in immunoassay for i in range(4)])
+
+        # Lecturas de listas (incluye campos función)
+        sample_fields = ['name', 'patient', 'sample_type', 'state',
+            'origin_institution', 'all_processes_completed',
+            'active_process_count', 'total_process_count']
+        process_fields = ['name', 'patient', 'sample_type', 'state',
+            'responsible_professional']
+        with bench.measure('read sample tree', len(samples)):
+            Sample.read([s.id for s in samples], sample_fields)
+        for Model, records in [(Molecular, molecular),
+                (Histopathology, histopathology),
+                (Immunoassay, immunoassay)]:
+            with bench.measure('read %s tree' % Model.__name__, len(records)):
+                Model.read([r.id for r in records], process_fields)
+
+        # Lista de trabajo con todos los procesos abiertos
+        with bench.measure('read worklist',
+                len(molecular) + len(histopathology) + len(immunoassay)):
+            Worklist.search_read([], fields_names=['name', 'specialty',
+                    'state', 'start_date', 'age'])
+
+        # Botones de estado de los procesos
+        with bench.measure('button molecular start+complete', len(molecular)):
+            Molecular.start_process(molecular)
+            Molecular.complete_process(molecular)
+        with bench.measure('buttons histopathology stages',
+                len(histopathology)):
+            Histopathology.write(histopathology, {
+                    'number_of_cuts': 2,
+                    'number_of_cassettes': 1,
+                    })
+            Histopathology.start_macroscopy(histopathology)
+            Histopathology.complete_macroscopy(histopathology)
+            Histopathology.complete_processing(histopathology)
+            Histopathology.complete_cutting(histopathology)
+            Histopathology.complete_staining(histopathology)
+        with bench.measure('button immunoassay start+cancel',
+                len(immunoassay)):
+            Immunoassay.start_process(immunoassay)
+            Immunoassay.cancel(immunoassay)
+
+        # Tiempos de respuesta de lo completado hoy
+        with Transaction().set_context(from_date=date.today(),
+                to_date=date.today()):
+            with bench.measure('read turnaround report', 1):
+                Turnaround.search_read([], fields_names=['specialty',
+                        'count', 'p50', 'p90', 'p99'])
+
+        # Muestras listas para completar
+        with bench.measure('search all_processes_completed', 1):
+            ready = Sample.search([('all_processes_completed', '=', True)])
+        with bench.measure('read all_processes_completed', len(samples)):
+            Sample.read([s.id for s in samples], ['all_processes_completed'])
+        with bench.measure('button sample auto_complete', len(ready)):
+            Sample.auto_complete(ready)
+
+        with bench.measure('wizard create_lab_test_from_workflow', len(ready)):
+            run_wizard('gnuhealth.create_lab_test_from_workflow',
+                'create_lab_test',
+                'gnuhealth.lab.workflow.sample', [s.id for s in ready])
+
+        pending = [s for s in samples if s not in ready]
+        with bench.measure('button sample reject', len(pending)):
+            Sample.reject(pending)
+
+        transaction.rollback()
+    bench.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the health_lab_workflow hot paths')
+    parser.add_argument('--orders', type=int, default=300,
+        help='number of synthetic lab orders')
+    main(parser.parse_args().orders)
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from trytond.model import ModelView, ModelSQL, ModelSingleton, fields
+
+__all__ = ['GnuHealthLabWorkflowConfiguration']
+
+
+class GnuHealthLabWorkflowConfiguration(ModelSingleton, ModelSQL, ModelView):
+    'Lab Workflow Configuration'
+    __name__ = 'gnuhealth.lab.workflow.configuration'
+    
+    auto_complete_samples = fields.Boolean('Auto-complete Samples',
+        help='Complete the workflow sample in the same transaction when '
+        'its last active process is completed or cancelled')
+    
+    @staticmethod
+    def default_auto_complete_samples():
+        return False
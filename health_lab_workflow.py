@@ -1,16 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from trytond.model import ModelView, ModelSQL, fields
+import logging
+import re
+from collections import defaultdict
+
+from sql import Cast, Literal, Null, Union, Window
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import RowNumber
+from sql.operators import Equality
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.exceptions import UserWarning
+from trytond.model import (ModelView, ModelSQL, Index, Unique, Exclude,
+    fields)
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.transaction import Transaction
-from trytond.exceptions import UserWarning
-from datetime import datetime
+from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
+from datetime import datetime, timedelta
+
+from .instrumentation import instrument
 
-__all__ = ['GnuHealthLabWorkflowSample', 'GnuHealthLab', 
-           'CreateLabWorkflowStart', 'CreateLabWorkflowWizard']
+logger = logging.getLogger(__name__)
+
+__all__ = ['WorkflowProcessMixin', 'GnuHealthLabWorkflowSample', 'GnuHealthLab', 
+           'CreateLabWorkflowStart', 'CreateLabWorkflowResult',
+           'CreateLabWorkflowWizard']
 
 # Definición de tipos de muestra
 SAMPLE_TYPES = [
@@ -28,6 +49,45 @@ SAMPLE_TYPES = [
     ('other', 'Other'),
 ]
 
+# Estados del workflow de la muestra
+SAMPLE_STATES = [
+    ('pending', 'Pending Collection'),
+    ('collected', 'Collected'),
+    ('in_transit', 'In Transit'),
+    ('received', 'Received at Lab'),
+    ('processing', 'Processing'),
+    ('completed', 'Completed'),
+    ('rejected', 'Rejected'),
+]
+
+# Acciones del modo estación: botón -> estados desde los que se permite
+STATION_ACTIONS = {
+    'collect': ['pending'],
+    'receive': ['collected', 'in_transit'],
+    'process': ['received'],
+}
+
+# Modelos de proceso por especialidad asociados a una muestra
+PROCESS_MODELS = [
+    ('molecular_biology', 'gnuhealth.lab.molecular_biology'),
+    ('histopathology', 'gnuhealth.lab.histopathology'),
+    ('immunoassay', 'gnuhealth.lab.immunoassay'),
+]
+
+# Estados en los que un proceso ya no está activo
+PROCESS_CLOSED_STATES = ['completed', 'cancelled']
+
+
+def unique_active_process():
+    """Indica si la base de datos garantiza un solo proceso activo por
+    muestra y especialidad (restricción EXCLUDE de PostgreSQL, opcional):
+
+        [health_lab_workflow]
+        unique_active_process = True
+    """
+    return config.getboolean(
+        'health_lab_workflow', 'unique_active_process', default=False)
+
 
 def get_institution():
     """Función auxiliar para obtener la institución"""
@@ -38,6 +98,83 @@ def get_institution():
         return None
 
 
+class WorkflowProcessMixin(object):
+    """Comportamiento común de los procesos de las tres especialidades:
+    índice y restricción de proceso activo por muestra, historial de
+    transiciones y contadores de procesos de la muestra"""
+    __slots__ = ()
+    
+    # Especialidad del historial y aviso de proceso activo duplicado
+    _workflow_specialty = None
+    _active_process_warning = None
+    
+    @classmethod
+    def __setup__(cls):
+        super(WorkflowProcessMixin, cls).__setup__()
+        t = cls.__table__()
+        # Usado por la verificación de procesos activos por muestra
+        cls._sql_indexes.add(
+            Index(t,
+                (t.workflow_sample, Index.Range()),
+                (t.state, Index.Equality())))
+        if unique_active_process():
+            # Un solo proceso activo por muestra garantizado por la base
+            cls._sql_constraints += [
+                ('workflow_sample_active_exclude',
+                    Exclude(t, (t.workflow_sample, Equality()),
+                        where=~t.state.in_(PROCESS_CLOSED_STATES)),
+                    'health_lab_workflow.msg_active_process_exists'),
+                ]
+    
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Sample = pool.get('gnuhealth.lab.workflow.sample')
+        Transition = pool.get('gnuhealth.lab.workflow.transition')
+        Warning = pool.get('res.user.warning')
+        
+        # Un solo proceso activo por muestra: una búsqueda para todo el lote
+        if (not unique_active_process()
+                and Sample.has_active_process(cls, vlist)):
+            name, message = cls._active_process_warning
+            key = Warning.format(name, [v.get('workflow_sample')
+                    for v in vlist])
+            if Warning.check(key):
+                raise UserWarning(key, message)
+        
+        records = super(WorkflowProcessMixin, cls).create(vlist)
+        Transition.log(Transition.creations(cls._workflow_specialty, records))
+        Sample.update_process_counters(
+            [r.workflow_sample.id for r in records])
+        return records
+    
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Sample = pool.get('gnuhealth.lab.workflow.sample')
+        Transition = pool.get('gnuhealth.lab.workflow.transition')
+        transitions = Transition.changes(cls._workflow_specialty, args)
+        sample_ids = set()
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if 'state' in values or 'workflow_sample' in values:
+                sample_ids.update(r.workflow_sample.id for r in records)
+                if values.get('workflow_sample'):
+                    sample_ids.add(values['workflow_sample'])
+        
+        super(WorkflowProcessMixin, cls).write(*args)
+        Transition.log(transitions)
+        if sample_ids:
+            Sample.update_process_counters(sample_ids)
+    
+    @classmethod
+    def delete(cls, records):
+        Sample = Pool().get('gnuhealth.lab.workflow.sample')
+        sample_ids = {r.workflow_sample.id for r in records}
+        super(WorkflowProcessMixin, cls).delete(records)
+        Sample.update_process_counters(sample_ids)
+
+
 class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
     'Lab Workflow Sample'
     __name__ = 'gnuhealth.lab.workflow.sample'
@@ -51,13 +188,24 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
         required=True, ondelete='CASCADE',
         help='Lab test order this sample belongs to')
     
+    # Solicitud de examen que originó la muestra
+    lab_test_request = fields.Many2One('gnuhealth.patient.lab.test',
+        'Lab Test Request', readonly=True,
+        help='Lab test request this sample was created from')
+    
+    # Último error de la tarea programada de reportes
+    lab_report_error = fields.Char('Lab Report Error', readonly=True,
+        help='Why the scheduled task could not create the lab test report. '
+        'The task skips the sample until the report is created from the '
+        'Create Lab Test wizard')
+    
     # ID del test de laboratorio (campo función)
     lab_test_id = fields.Function(fields.Char('Lab Test ID'),
-        'get_lab_test_id')
+        'get_lab_test_info')
     
     # Información del paciente (campo función desde lab_test)
     patient = fields.Function(fields.Many2One('gnuhealth.patient', 'Patient'),
-        'get_patient')
+        'get_lab_test_info')
     
     # Establecimiento de origen
     origin_institution = fields.Many2One('gnuhealth.institution',
@@ -68,15 +216,8 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
     sample_type = fields.Selection(SAMPLE_TYPES, 'Sample Type', required=True)
     
     # Estado del workflow
-    state = fields.Selection([
-        ('pending', 'Pending Collection'),
-        ('collected', 'Collected'),
-        ('in_transit', 'In Transit'),
-        ('received', 'Received at Lab'),
-        ('processing', 'Processing'),
-        ('completed', 'Completed'),
-        ('rejected', 'Rejected'),
-    ], 'State', readonly=True, required=True)
+    state = fields.Selection(SAMPLE_STATES, 'State', readonly=True,
+        required=True)
     
     # Fechas del proceso
     collection_date = fields.DateTime('Collection Date',
@@ -91,12 +232,117 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
     
     # Campo función para verificar si todos los procesos están completos
     all_processes_completed = fields.Function(fields.Boolean('All Processes Completed'),
-        'get_all_processes_completed')
+        'get_all_processes_completed',
+        searcher='search_all_processes_completed')
+    
+    # Contadores de procesos mantenidos por los modelos de cada especialidad
+    molecular_biology_active = fields.Integer('Active Molecular Biology',
+        readonly=True)
+    molecular_biology_total = fields.Integer('Total Molecular Biology',
+        readonly=True)
+    histopathology_active = fields.Integer('Active Histopathology',
+        readonly=True)
+    histopathology_total = fields.Integer('Total Histopathology',
+        readonly=True)
+    immunoassay_active = fields.Integer('Active Immunoassay', readonly=True)
+    immunoassay_total = fields.Integer('Total Immunoassay', readonly=True)
+    active_process_count = fields.Integer('Active Processes', readonly=True,
+        help='Number of processes not yet completed or cancelled')
+    total_process_count = fields.Integer('Total Processes', readonly=True,
+        help='Number of processes created for this sample')
+    
+    # Etiquetas traducidas del tipo de muestra, por idioma
+    _sample_type_labels = Cache(
+        'gnuhealth.lab.workflow.sample.sample_type_labels')
+    
+    # Contadores del tablero; se invalidan al escribir muestras o procesos
+    _dashboard_counts = Cache('gnuhealth.lab.workflow.sample.dashboard_counts',
+        duration=timedelta(seconds=30))
+    
+    @classmethod
+    def __register__(cls, module_name):
+        # Al actualizar desde una versión sin contadores, recalcularlos
+        migrate_counters = migrate_request = False
+        if backend.TableHandler.table_exist(cls._table):
+            table_h = cls.__table_handler__(module_name)
+            migrate_counters = not table_h.column_exist('total_process_count')
+            migrate_request = not table_h.column_exist('lab_test_request')
+        
+        super(GnuHealthLabWorkflowSample, cls).__register__(module_name)
+        
+        if migrate_counters:
+            # Las columnas nuevas ya tienen el valor por defecto (0)
+            cls._rebuild_process_counters(reset=False)
+        elif config.getboolean(
+                'health_lab_workflow', 'rebuild_counters', default=False):
+            # Reparación explícita: trytond-admin -u health_lab_workflow
+            # con rebuild_counters = True en la configuración
+            cls._rebuild_process_counters(reset=True)
+        if migrate_request:
+            cls._migrate_lab_test_request()
+    
+    @classmethod
+    def _migrate_lab_test_request(cls):
+        """Enlaza las muestras existentes con su solicitud: primero por el
+        número de orden de su lab test y luego por el número de la muestra,
+        con un UPDATE para todas las muestras en cada caso"""
+        pool = Pool()
+        Lab = pool.get('gnuhealth.lab')
+        LabTestRequest = pool.get('gnuhealth.patient.lab.test')
+        cursor = Transaction().connection.cursor()
+        sample = cls.__table__()
+        lab = Lab.__table__()
+        
+        def best_request(number):
+            # Preferir la solicitud en estado 'ordered', como el wizard
+            # de reportes, y si no la más antigua con ese número
+            request = LabTestRequest.__table__()
+            return request.select(request.id,
+                where=request.request == number,
+                order_by=[
+                    Case((request.state == 'ordered', 0), else_=1),
+                    request.id.asc],
+                limit=1)
+        
+        requested = LabTestRequest.__table__()
+        cursor.execute(*sample.update(
+                [sample.lab_test_request],
+                [best_request(lab.request_order)],
+                from_=[lab],
+                where=(sample.lab_test == lab.id)
+                & (sample.lab_test_request == Null)
+                & lab.request_order.in_(
+                    requested.select(requested.request))))
+        
+        # Las que siguen sin enlazar, por el número de la muestra
+        cursor.execute(*sample.update(
+                [sample.lab_test_request],
+                [best_request(Cast(sample.name, 'INTEGER'))],
+                where=(sample.lab_test_request == Null)
+                & sample.name.in_(requested.select(
+                        Cast(requested.request, 'VARCHAR')))))
     
     @classmethod
     def __setup__(cls):
         super(GnuHealthLabWorkflowSample, cls).__setup__()
         cls._order = [('create_date', 'DESC')]
+        t = cls.__table__()
+        # El número de orden identifica la muestra en todo el proceso
+        cls._sql_constraints += [
+            ('name_uniq', Unique(t, t.name),
+                'health_lab_workflow.msg_workflow_sample_name_unique'),
+        ]
+        cls._sql_indexes.update({
+            Index(t, (t.name, Index.Similarity())),
+            Index(t, (t.lab_test, Index.Range())),
+            Index(t, (t.lab_test_request, Index.Range())),
+            Index(t, (t.state, Index.Equality())),
+            Index(t, (t.create_date, Index.Range())),
+        })
+        cls.__rpc__.update({
+            'apply_station_scans': RPC(readonly=False),
+            'get_dashboard_counts': RPC(),
+        })
         cls._buttons.update({
             'collect': {
                 'invisible': Eval('state') != 'pending',
@@ -144,80 +390,308 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
     def default_origin_institution():
         return get_institution()
     
-    def get_patient(self, name):
-        """Obtiene el paciente desde la orden de laboratorio"""
-        if self.lab_test and self.lab_test.patient:
-            return self.lab_test.patient.id
-        return None
+    @staticmethod
+    def default_molecular_biology_active():
+        return 0
     
-    def get_lab_test_id(self, name):
-        """Obtiene el ID del test de laboratorio"""
-        if self.lab_test:
-            return self.lab_test.name
-        return ''
+    @staticmethod
+    def default_molecular_biology_total():
+        return 0
     
-    def get_all_processes_completed(self, name):
-        """Verifica si todos los procesos están completados"""
-        pool = Pool()
+    @staticmethod
+    def default_histopathology_active():
+        return 0
+    
+    @staticmethod
+    def default_histopathology_total():
+        return 0
+    
+    @staticmethod
+    def default_immunoassay_active():
+        return 0
+    
+    @staticmethod
+    def default_immunoassay_total():
+        return 0
+    
+    @staticmethod
+    def default_active_process_count():
+        return 0
+    
+    @staticmethod
+    def default_total_process_count():
+        return 0
+    
+    @classmethod
+    @instrument
+    def get_lab_test_info(cls, samples, names):
+        """Paciente e ID del test de laboratorio de un lote de muestras, con
+        una consulta por grupo de ids"""
+        Lab = Pool().get('gnuhealth.lab')
+        cursor = Transaction().connection.cursor()
+        sample = cls.__table__()
+        lab = Lab.__table__()
         
-        # Verificar procesos de biología molecular
-        MolecularBiology = pool.get('gnuhealth.lab.molecular_biology')
-        molecular_processes = MolecularBiology.search([
-            ('workflow_sample', '=', self.id),
-            ('state', 'not in', ['completed', 'cancelled']),
-        ])
+        result = {
+            'patient': {s.id: None for s in samples},
+            'lab_test_id': {s.id: '' for s in samples},
+            }
+        for sub_ids in grouped_slice([s.id for s in samples]):
+            cursor.execute(*sample.join(lab,
+                    condition=sample.lab_test == lab.id
+                    ).select(sample.id, lab.patient, lab.name,
+                    where=reduce_ids(sample.id, sub_ids)))
+            for sample_id, patient, lab_test_id in cursor:
+                result['patient'][sample_id] = patient
+                result['lab_test_id'][sample_id] = lab_test_id or ''
+        return {n: result[n] for n in names}
+    
+    @classmethod
+    def get_sample_type_labels(cls):
+        """Mapa código -> descripción del tipo de muestra en el idioma actual"""
+        language = Transaction().language
+        labels = cls._sample_type_labels.get(language)
+        if labels is None:
+            selection = cls.fields_get(
+                ['sample_type'])['sample_type']['selection']
+            labels = dict(selection)
+            cls._sample_type_labels.set(language, labels)
+        return labels
+
+    @classmethod
+    def get_process_sample_info(cls, Process, processes, names):
+        """Obtiene la información de la muestra para un lote de procesos"""
+        pool = Pool()
+        Lab = pool.get('gnuhealth.lab')
+        cursor = Transaction().connection.cursor()
+        process = Process.__table__()
+        sample = cls.__table__()
+        lab = Lab.__table__()
         
-        # Verificar procesos de histopatología
-        try:
-            Histopathology = pool.get('gnuhealth.lab.histopathology')
-            histopathology_processes = Histopathology.search([
-                ('workflow_sample', '=', self.id),
-                ('state', 'not in', ['completed', 'cancelled']),
-            ])
-        except:
-            histopathology_processes = []
+        result = {n: {p.id: None for p in processes} for n in names}
+        labels = cls.get_sample_type_labels() if 'sample_type' in names else {}
         
-        # Verificar procesos de inmunoensayo
-        try:
-            Immunoassay = pool.get('gnuhealth.lab.immunoassay')
-            immunoassay_processes = Immunoassay.search([
-                ('workflow_sample', '=', self.id),
-                ('state', 'not in', ['completed', 'cancelled']),
-            ])
-        except:
-            immunoassay_processes = []
+        for sub_ids in grouped_slice([p.id for p in processes]):
+            cursor.execute(*process.join(sample,
+                    condition=process.workflow_sample == sample.id
+                    ).join(lab, 'LEFT', condition=sample.lab_test == lab.id
+                    ).select(process.id, sample.name, sample.sample_type,
+                    lab.patient,
+                    where=reduce_ids(process.id, sub_ids)))
+            for process_id, number, sample_type, patient in cursor:
+                if 'name' in result:
+                    result['name'][process_id] = number
+                if 'patient' in result:
+                    result['patient'][process_id] = patient
+                if 'sample_type' in result:
+                    result['sample_type'][process_id] = labels.get(
+                        sample_type, '') if sample_type else ''
+        return result
+
+    @classmethod
+    def _sample_types_matching(cls, operator, value):
+        """Códigos de tipo de muestra cuya descripción o código cumplen la
+        condición (sin el 'not', que resuelve quien llama)"""
+        labels = cls.get_sample_type_labels()
+        if operator in {'in', 'not in'}:
+            values = set(value or [])
+            return [c for c, l in labels.items()
+                if c in values or l in values]
+        if operator in {'=', '!='}:
+            return [c for c, l in labels.items() if value in {c, l}]
+        # like / ilike: traducir el patrón SQL a una expresión regular
+        pattern = ''.join('.*' if c == '%' else '.' if c == '_'
+            else re.escape(c) for c in (value or ''))
+        flags = re.IGNORECASE if 'ilike' in operator else 0
+        regex = re.compile('^%s$' % pattern, flags | re.DOTALL)
+        return [c for c, l in labels.items()
+            if regex.match(c) or regex.match(l or '')]
+
+    @classmethod
+    def search_process_sample_info(cls, name, clause):
+        """Dominio para buscar procesos por datos de su muestra; se resuelve
+        como subconsulta sobre workflow_sample, sin materializar ids"""
+        if name == 'name':
+            return [('workflow_sample.' + clause[0],) + tuple(clause[1:])]
+        elif name == 'patient':
+            return [('workflow_sample.lab_test.' + clause[0],)
+                + tuple(clause[1:])]
+        elif name == 'sample_type':
+            _, operator, value = clause[:3]
+            positive = operator.replace('not ', '', 1).replace('!=', '=')
+            codes = cls._sample_types_matching(positive, value)
+            return [('workflow_sample.sample_type',
+                    'not in' if positive != operator else 'in', codes)]
+        return []
+
+    @classmethod
+    def _process_union(cls, sample_ids=None):
+        """Une los procesos de las tres especialidades marcando los activos"""
+        pool = Pool()
+        queries = []
+        for specialty, model_name in PROCESS_MODELS:
+            process = pool.get(model_name).__table__()
+            where = None
+            if sample_ids is not None:
+                where = reduce_ids(process.workflow_sample, sample_ids)
+            queries.append(process.select(
+                    process.workflow_sample.as_('sample'),
+                    Literal(specialty).as_('specialty'),
+                    Case((process.state.in_(PROCESS_CLOSED_STATES), 0),
+                        else_=1).as_('active'),
+                    where=where))
+        return Union(*queries, all_=True)
+
+    @classmethod
+    def has_active_process(cls, Process, vlist):
+        """Indica si alguno de los procesos a crear repetiría un proceso
+        activo de la misma muestra, ya existente o dentro del mismo lote"""
+        sample_ids = [v['workflow_sample'] for v in vlist
+            if v.get('workflow_sample')
+            and v.get('state', 'draft') not in PROCESS_CLOSED_STATES]
+        if len(sample_ids) != len(set(sample_ids)):
+            return True
+        for sub_ids in grouped_slice(sample_ids):
+            if Process.search([
+                        ('workflow_sample', 'in', list(sub_ids)),
+                        ('state', 'not in', PROCESS_CLOSED_STATES),
+                        ], limit=1):
+                return True
+        return False
+
+    @classmethod
+    def update_process_counters(cls, sample_ids):
+        """Recalcula los contadores de procesos de las muestras indicadas"""
+        sample_ids = list({i for i in sample_ids if i is not None})
+        for sub_ids in grouped_slice(sample_ids):
+            cls._store_process_counters(list(sub_ids))
+        if sample_ids:
+            cls._dashboard_counts.clear()
+
+    @classmethod
+    def _store_process_counters(cls, sample_ids, reset=True):
+        """Escribe con SQL los contadores de un lote de muestras: un UPDATE
+        desde el agregado de los procesos de las tres especialidades. No pasa
+        por write() para no validar ni cambiar write_date de la muestra, que
+        el usuario puede tener abierta"""
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        sample = cls.__table__()
+        processes = cls._process_union(sample_ids)
         
-        # Si hay procesos activos, no está completo
-        if molecular_processes or histopathology_processes or immunoassay_processes:
-            return False
+        names = ['total_process_count', 'active_process_count']
+        aggregates = [
+            processes.sample.as_('sample'),
+            Count(Literal('*')).as_('total_process_count'),
+            Sum(processes.active).as_('active_process_count'),
+            ]
+        for specialty, _ in PROCESS_MODELS:
+            is_specialty = processes.specialty == specialty
+            names.extend(['%s_total' % specialty, '%s_active' % specialty])
+            aggregates.extend([
+                    Sum(Case((is_specialty, 1), else_=0)
+                        ).as_('%s_total' % specialty),
+                    Sum(Case((is_specialty, processes.active), else_=0)
+                        ).as_('%s_active' % specialty),
+                    ])
+        counts = processes.select(*aggregates, group_by=[processes.sample])
         
-        # Verificar que al menos haya un proceso completado
-        # (no queremos auto-completar si no hay procesos)
-        pool = Pool()
-        MolecularBiology = pool.get('gnuhealth.lab.molecular_biology')
-        total_molecular = len(MolecularBiology.search([
-            ('workflow_sample', '=', self.id),
-        ]))
+        columns = [getattr(sample, n) for n in names]
+        if reset:
+            # Las muestras sin procesos no aparecen en el agregado
+            cursor.execute(*sample.update(columns, [0] * len(columns),
+                    where=reduce_ids(sample.id, sample_ids)))
+        cursor.execute(*sample.update(columns,
+                [getattr(counts, n) for n in names],
+                from_=[counts],
+                where=sample.id == counts.sample))
+        # Invalida los registros en caché de la transacción
+        transaction.counter += 1
+
+    @classmethod
+    def _rebuild_process_counters(cls, reset):
+        """Recalcula en bloque los contadores de todas las muestras; solo se
+        ejecuta al actualizar el módulo"""
+        cursor = Transaction().connection.cursor()
+        sample = cls.__table__()
+        cursor.execute(*sample.select(sample.id))
+        sample_ids = [i for i, in cursor]
+        for sub_ids in grouped_slice(sample_ids, 10000):
+            cls._store_process_counters(list(sub_ids), reset=reset)
+        cls._dashboard_counts.clear()
+
+    @classmethod
+    @instrument
+    def get_all_processes_completed(cls, samples, name):
+        """Verifica si todos los procesos están completados"""
+        # Sin procesos no se auto-completa una muestra vacía
+        return {s.id: bool(s.total_process_count
+                and not s.active_process_count) for s in samples}
+
+    @classmethod
+    def search_all_processes_completed(cls, name, clause):
+        """Permite filtrar las muestras listas para auto-completar"""
+        _, operator, value = clause
+        # Valores booleanos que cumplen la condición
+        if operator == '=':
+            matches = {bool(value)}
+        elif operator == '!=':
+            matches = {not value}
+        elif operator == 'in':
+            matches = {bool(v) for v in value}
+        elif operator == 'not in':
+            matches = {True, False} - {bool(v) for v in value}
+        else:
+            raise ValueError('Unsupported operator for %s: %s'
+                % (name, operator))
         
-        try:
-            Histopathology = pool.get('gnuhealth.lab.histopathology')
-            total_histopathology = len(Histopathology.search([
-                ('workflow_sample', '=', self.id),
-            ]))
-        except:
-            total_histopathology = 0
+        if matches == {True, False}:
+            return []
+        elif matches == {True}:
+            return [
+                ('total_process_count', '>', 0),
+                ('active_process_count', '=', 0),
+                ]
+        elif matches == {False}:
+            return ['OR',
+                ('total_process_count', '=', 0),
+                ('total_process_count', '=', None),
+                ('active_process_count', '>', 0),
+                ]
+        return [('id', '=', -1)]
+
+    @classmethod
+    def get_dashboard_counts(cls):
+        """Cantidad de muestras por estado e institución de origen y de
+        procesos abiertos por especialidad, con una sola consulta agregada
+        sobre los contadores almacenados"""
+        counts = cls._dashboard_counts.get(None)
+        if counts is not None:
+            return counts
         
-        try:
-            Immunoassay = pool.get('gnuhealth.lab.immunoassay')
-            total_immunoassay = len(Immunoassay.search([
-                ('workflow_sample', '=', self.id),
-            ]))
-        except:
-            total_immunoassay = 0
+        cursor = Transaction().connection.cursor()
+        sample = cls.__table__()
+        columns = [Sum(Coalesce(getattr(sample, '%s_active' % specialty), 0))
+            for specialty, _ in PROCESS_MODELS]
+        cursor.execute(*sample.select(
+                sample.state, sample.origin_institution,
+                Count(Literal('*')), *columns,
+                group_by=[sample.state, sample.origin_institution]))
         
-        # Si hay al menos un proceso y ninguno está activo, está completo
-        total_processes = total_molecular + total_histopathology + total_immunoassay
-        return total_processes > 0
+        counts = {
+            'samples': [],
+            'processes': {specialty: 0 for specialty, _ in PROCESS_MODELS},
+            }
+        for state, institution, count, *active in cursor:
+            counts['samples'].append({
+                    'state': state,
+                    'origin_institution': institution,
+                    'count': count,
+                    })
+            for (specialty, _), value in zip(PROCESS_MODELS, active):
+                counts['processes'][specialty] += int(value or 0)
+        cls._dashboard_counts.set(None, counts)
+        return counts
     
     @fields.depends('lab_test')
     def on_change_lab_test(self):
@@ -236,9 +710,209 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
                 lab = Lab(values['lab_test'])
                 if hasattr(lab, 'request_order') and lab.request_order is not None:
                     values['name'] = str(lab.request_order)
-        return super(GnuHealthLabWorkflowSample, cls).create(vlist)
+        samples = super(GnuHealthLabWorkflowSample, cls).create(vlist)
+        
+        Transition = Pool().get('gnuhealth.lab.workflow.transition')
+        Transition.log(Transition.creations('sample', samples))
+        cls._dashboard_counts.clear()
+        return samples
+    
+    @classmethod
+    def write(cls, *args):
+        # Registrar los cambios de estado en el historial
+        Transition = Pool().get('gnuhealth.lab.workflow.transition')
+        transitions = Transition.changes('sample', args)
+        super(GnuHealthLabWorkflowSample, cls).write(*args)
+        Transition.log(transitions)
+        # Cambian los estados y orígenes que cuenta el tablero
+        cls._dashboard_counts.clear()
+    
+    @classmethod
+    def delete(cls, samples):
+        super(GnuHealthLabWorkflowSample, cls).delete(samples)
+        cls._dashboard_counts.clear()
+    
+    @classmethod
+    def apply_station_scans(cls, action, numbers):
+        """Aplica una acción de estación a una serie de números de orden
+        escaneados y devuelve el detalle de los escaneos aplicados, los
+        desconocidos y los que no están en un estado válido"""
+        if action not in STATION_ACTIONS:
+            raise ValueError('Unknown station action: %s' % action)
+        
+        # Quitar espacios y escaneos repetidos conservando el orden
+        numbers = list(dict.fromkeys(
+                n.strip() for n in numbers if n and n.strip()))
+        samples = {}
+        for sub_numbers in grouped_slice(numbers):
+            samples.update((s.name, s) for s in cls.search([
+                        ('name', 'in', list(sub_numbers)),
+                        ]))
+        
+        report = {'done': [], 'unknown': [], 'invalid': []}
+        to_apply = []
+        for number in numbers:
+            sample = samples.get(number)
+            if not sample:
+                report['unknown'].append(number)
+            elif sample.state not in STATION_ACTIONS[action]:
+                report['invalid'].append(number)
+            else:
+                report['done'].append(number)
+                to_apply.append(sample)
+        
+        # El botón escribe estado y fecha de todas las muestras a la vez
+        if to_apply:
+            getattr(cls, action)(to_apply)
+        return report
+    
+    @classmethod
+    def create_lab_reports(cls, samples):
+        """Crea los reportes de laboratorio de las muestras completadas y
+        devuelve la lista de (número de orden, motivo) de las omitidas"""
+        pool = Pool()
+        Lab = pool.get('gnuhealth.lab')
+        PatientLabTest = pool.get('gnuhealth.patient.lab.test')
+        TestType = pool.get('gnuhealth.lab.test_type')
+        
+        errors = []
+        
+        # Labs que ya tienen criterios, en una sola lectura
+        lab_ids = list({s.lab_test.id for s in samples if s.lab_test})
+        with_criteria = {l['id'] for l in Lab.read(lab_ids, ['critearea'])
+            if l['critearea']}
+        
+        pending = []
+        for sample in samples:
+            if sample.state != 'completed':
+                errors.append((sample.name,
+                        'The workflow sample must be completed before '
+                        'creating the lab test report.'))
+            elif sample.lab_test and sample.lab_test.id in with_criteria:
+                errors.append((sample.name,
+                        'A lab test report already exists for this workflow '
+                        'sample.'))
+            else:
+                pending.append(sample)
+        
+        # Resolver las solicitudes sin enlace directo en una sola consulta
+        unlinked = {s.name for s in pending
+            if not s.lab_test_request and s.name and s.name.isdigit()}
+        requests = {}
+        if unlinked:
+            for lab_test_request in PatientLabTest.search([
+                        ('request', 'in', [int(n) for n in unlinked]),
+                        ('state', '=', 'ordered'),
+                        ]):
+                requests.setdefault(
+                    str(lab_test_request.request), lab_test_request)
+        
+        to_write, to_create, to_link, done = [], [], [], []
+        for sample in pending:
+            lab_test_request = (sample.lab_test_request
+                or requests.get(sample.name))
+            if not lab_test_request:
+                errors.append((sample.name,
+                        'Could not find the original lab test request for '
+                        'this workflow sample.'))
+                continue
+            
+            # Criterios basados en el tipo de test (plantilla en caché)
+            test_cases = [('create',
+                    TestType.get_criteria_template(lab_test_request.name))]
+            
+            done.append(sample)
+            if sample.lab_test:
+                # Lab test existente sin criterios
+                to_write.extend([[sample.lab_test], {
+                            'critearea': test_cases,
+                            }])
+            else:
+                # Nuevo lab test completo (igual que el wizard de health_lab)
+                lab_test_data = {
+                    'test': lab_test_request.name.id,
+                    'source_type': lab_test_request.source_type,
+                    'patient': (lab_test_request.patient_id
+                        and lab_test_request.patient_id.id),
+                    'other_source': lab_test_request.other_source,
+                    'requestor': (lab_test_request.doctor_id
+                        and lab_test_request.doctor_id.id),
+                    'date_requested': lab_test_request.date,
+                    'request_order': lab_test_request.request,
+                    'critearea': test_cases,
+                }
+                if sample.origin_institution and 'institution' in Lab._fields:
+                    lab_test_data['institution'] = (
+                        sample.origin_institution.id)
+                to_create.append(lab_test_data)
+                to_link.append(sample)
+        
+        if to_write:
+            Lab.write(*to_write)
+        if to_create:
+            labs = Lab.create(to_create)
+            # Enlazar las muestras con sus nuevos lab tests
+            cls.write(*[x for sample, lab in zip(to_link, labs)
+                    for x in ([sample], {'lab_test': lab.id})])
+        # La tarea programada vuelve a considerar las muestras resueltas
+        resolved = [s for s in done if s.lab_report_error]
+        if resolved:
+            cls.write(resolved, {'lab_report_error': None})
+        return errors
+    
+    @classmethod
+    def generate_lab_reports(cls):
+        """Tarea programada: reportes para las muestras completadas que
+        todavía no tienen criterios. Los fallos se guardan en la muestra,
+        que no se reintenta hasta crear el reporte desde el asistente"""
+        samples = cls.search([
+                ('state', '=', 'completed'),
+                ('lab_test.critearea', '=', None),
+                ('lab_report_error', '=', None),
+                ])
+        for sub_samples in grouped_slice(samples, 1000):
+            sub_samples = list(sub_samples)
+            by_name = {s.name: s for s in sub_samples}
+            failed = defaultdict(list)
+            for name, error in cls.create_lab_reports(sub_samples):
+                logger.warning('Lab report not generated for sample %s: %s',
+                    name, error)
+                failed[error].append(by_name[name])
+            if failed:
+                cls.write(*[x for error, records in failed.items()
+                        for x in (records, {'lab_report_error': error})])
+    
+    @classmethod
+    def complete_finished(cls, sample_ids):
+        """Si está activado en la configuración, completa las muestras
+        indicadas cuyo último proceso activo acaba de cerrarse"""
+        Configuration = Pool().get('gnuhealth.lab.workflow.configuration')
+        if not Configuration(1).auto_complete_samples:
+            return
+        sample_ids = list({i for i in sample_ids if i is not None})
+        samples = []
+        for sub_ids in grouped_slice(sample_ids):
+            samples.extend(cls.search([
+                        ('id', 'in', list(sub_ids)),
+                        ('state', '=', 'processing'),
+                        ('all_processes_completed', '=', True),
+                        ]))
+        if samples:
+            cls.auto_complete(samples)
     
     @classmethod
+    def auto_complete_finished(cls):
+        """Tarea programada: completa las muestras en proceso que tienen
+        procesos y ninguno activo (según los contadores almacenados)"""
+        samples = cls.search([
+                ('state', '=', 'processing'),
+                ('all_processes_completed', '=', True),
+                ], order=[('id', 'ASC')])
+        for sub_samples in grouped_slice(samples, 1000):
+            cls.auto_complete(list(sub_samples))
+    
+    @classmethod
+    @instrument
     @ModelView.button
     def collect(cls, samples):
         cls.write(samples, {
@@ -247,6 +921,7 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
         })
     
     @classmethod
+    @instrument
     @ModelView.button
     def receive(cls, samples):
         cls.write(samples, {
@@ -255,6 +930,7 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
         })
     
     @classmethod
+    @instrument
     @ModelView.button
     def process(cls, samples):
         cls.write(samples, {
@@ -262,6 +938,7 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
         })
     
     @classmethod
+    @instrument
     @ModelView.button
     def complete(cls, samples):
         cls.write(samples, {
@@ -270,6 +947,7 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
         })
     
     @classmethod
+    @instrument
     @ModelView.button
     def auto_complete(cls, samples):
         """Completa automáticamente cuando todos los procesos están terminados"""
@@ -279,6 +957,7 @@ class GnuHealthLabWorkflowSample(ModelSQL, ModelView):
         })
     
     @classmethod
+    @instrument
     @ModelView.button
     def reject(cls, samples):
         cls.write(samples, {
@@ -316,23 +995,49 @@ class GnuHealthLab(metaclass=PoolMeta):
         help='Track sample collection and processing')
     
     # Campo para mostrar el estado actual de la muestra principal
-    sample_state = fields.Function(fields.Selection([
-        ('pending', 'Pending Collection'),
-        ('collected', 'Collected'),
-        ('in_transit', 'In Transit'),
-        ('received', 'Received at Lab'),
-        ('processing', 'Processing'),
-        ('completed', 'Completed'),
-        ('rejected', 'Rejected'),
-        ('no_sample', 'No Sample'),
-    ], 'Sample State'), 'get_sample_state')
-    
-    def get_sample_state(self, name):
-        """Obtiene el estado de la muestra principal"""
-        if self.workflow_samples:
-            # Retorna el estado de la primera muestra (o la más reciente)
-            return self.workflow_samples[0].state
-        return 'no_sample'
+    sample_state = fields.Function(fields.Selection(
+            SAMPLE_STATES + [('no_sample', 'No Sample')], 'Sample State'),
+        'get_sample_state', searcher='search_sample_state')
+    
+    @classmethod
+    def _latest_sample_query(cls, lab_ids=None):
+        """Muestras numeradas por orden, la más reciente primero"""
+        Sample = Pool().get('gnuhealth.lab.workflow.sample')
+        sample = Sample.__table__()
+        where = None
+        if lab_ids is not None:
+            where = reduce_ids(sample.lab_test, lab_ids)
+        return sample.select(sample.lab_test, sample.state,
+            RowNumber(window=Window([sample.lab_test],
+                    order_by=[sample.create_date.desc, sample.id.desc])
+                ).as_('position'),
+            where=where)
+    
+    @classmethod
+    @instrument
+    def get_sample_state(cls, labs, name):
+        """Obtiene el estado de la muestra más reciente de cada orden"""
+        cursor = Transaction().connection.cursor()
+        result = {l.id: 'no_sample' for l in labs}
+        for sub_ids in grouped_slice([l.id for l in labs]):
+            latest = cls._latest_sample_query(list(sub_ids))
+            cursor.execute(*latest.select(latest.lab_test, latest.state,
+                    where=latest.position == 1))
+            result.update(cursor)
+        return result
+    
+    @classmethod
+    def search_sample_state(cls, name, clause):
+        """Filtra las órdenes según el estado de su muestra más reciente"""
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        lab = cls.__table__()
+        latest = cls._latest_sample_query()
+        query = lab.join(latest, 'LEFT',
+            condition=(latest.lab_test == lab.id) & (latest.position == 1)
+            ).select(lab.id,
+            where=Operator(Coalesce(latest.state, 'no_sample'), value))
+        return [('id', 'in', query)]
 
 
 class CreateLabWorkflowStart(ModelView):
@@ -357,6 +1062,13 @@ class CreateLabWorkflowStart(ModelView):
         return get_institution()
 
 
+class CreateLabWorkflowResult(ModelView):
+    'Create Lab Workflow Sample - Result'
+    __name__ = 'gnuhealth.create_lab_workflow.result'
+    
+    summary = fields.Text('Summary', readonly=True)
+
+
 class CreateLabWorkflowWizard(Wizard):
     'Create Lab Workflow'
     __name__ = 'gnuhealth.create_lab_workflow'
@@ -367,42 +1079,57 @@ class CreateLabWorkflowWizard(Wizard):
             Button('Create', 'create_workflow', 'tryton-ok', default=True),
         ])
     create_workflow = StateTransition()
+    result = StateView('gnuhealth.create_lab_workflow.result',
+        'health_lab_workflow.create_lab_workflow_result_form', [
+            Button('Close', 'end', 'tryton-ok', default=True),
+        ])
 
+    @instrument
     def transition_create_workflow(self):
         pool = Pool()
         LabTestRequest = pool.get('gnuhealth.patient.lab.test')
         Lab = pool.get('gnuhealth.lab')
         Sample = pool.get('gnuhealth.lab.workflow.sample')
 
-        # Obtener el lab test request actual
-        lab_test_request = LabTestRequest(Transaction().context['active_id'])
+        # Obtener los lab test requests seleccionados
+        context = Transaction().context
+        request_ids = context.get('active_ids') or [context['active_id']]
+        lab_test_requests = LabTestRequest.browse(request_ids)
 
-        # Verificar el estado
-        if lab_test_request.state != 'draft':
-            raise UserWarning('invalid_state',
-                              'Lab Test Request must be in draft state to create workflow.')
-
-        # Verificar si ya existe un workflow para esta solicitud
-        existing = Sample.search([
-            ('name', '=', str(lab_test_request.request)),
-        ])
+        # Verificar si ya existen workflows o lab results (una consulta
+        # por modelo para toda la selección)
+        orders = [r.request for r in lab_test_requests]
+        existing = {s.name for s in Sample.search([
+                    ('name', 'in', [str(o) for o in orders]),
+                    ])}
+        lab_results = {}
+        for lab in Lab.search([('request_order', 'in', orders)]):
+            lab_results.setdefault(lab.request_order, lab)
 
-        if existing:
-            raise UserWarning('workflow_exists',
-                              'A workflow sample already exists for this lab test request.')
-
-        # Crear o buscar el Lab Result (requerido para el workflow)
-        lab_results = Lab.search([
-            ('request_order', '=', lab_test_request.request),
-        ])
+        errors = []
+        to_process = []
+        for lab_test_request in lab_test_requests:
+            number = str(lab_test_request.request)
+            if lab_test_request.state != 'draft':
+                errors.append((number,
+                        'Lab Test Request must be in draft state to create '
+                        'workflow.'))
+            elif number in existing:
+                errors.append((number,
+                        'A workflow sample already exists for this lab test '
+                        'request.'))
+            else:
+                existing.add(number)
+                to_process.append(lab_test_request)
 
-        if lab_results:
-            lab_result = lab_results[0]
-        else:
-            # Crear un Lab Result con los campos básicos requeridos
+        # Crear los Lab Results faltantes (requeridos para el workflow)
+        new_labs = []
+        for lab_test_request in to_process:
+            if lab_test_request.request in lab_results:
+                continue
             lab_result = Lab()
             lab_result.request_order = lab_test_request.request
-            lab_result.test = lab_test_request.test_type  # ✅ Asignar el tipo de test requerido
+            lab_result.test = lab_test_request.test_type
             lab_result.source_type = lab_test_request.source_type
             if lab_test_request.source_type == 'patient':
                 lab_result.patient = lab_test_request.patient_id
@@ -410,26 +1137,43 @@ class CreateLabWorkflowWizard(Wizard):
                 lab_result.other_source = lab_test_request.other_source
             lab_result.requestor = lab_test_request.doctor_id
             lab_result.date_requested = lab_test_request.date
-            lab_result.save()
-
-        # Crear el registro de workflow sample
-        sample = Sample()
-        sample.lab_test = lab_result  # Asignar el lab result (satisface el campo requerido)
-        sample.name = str(lab_test_request.request)  # Usar el campo 'request' correcto
-        sample.sample_type = self.start.sample_type
-        sample.notes = self.start.notes
-
-        # Copiar la institución de origen
-        if self.start.origin_institution:
-            sample.origin_institution = self.start.origin_institution
-        elif hasattr(lab_test_request, 'origin_institution') and lab_test_request.origin_institution:
-            sample.origin_institution = lab_test_request.origin_institution
-
-        sample.save()
-
-        # Cambiar el estado del lab test request a 'ordered'
-        LabTestRequest.write([lab_test_request], {
-            'state': 'ordered',
-        })
+            lab_results[lab_test_request.request] = lab_result
+            new_labs.append(lab_result)
+        Lab.save(new_labs)
+
+        # Crear los registros de workflow sample
+        samples = []
+        for lab_test_request in to_process:
+            sample = Sample()
+            sample.lab_test = lab_results[lab_test_request.request]
+            sample.lab_test_request = lab_test_request
+            sample.name = str(lab_test_request.request)
+            sample.sample_type = self.start.sample_type
+            sample.notes = self.start.notes
+
+            # Copiar la institución de origen
+            if self.start.origin_institution:
+                sample.origin_institution = self.start.origin_institution
+            elif (hasattr(lab_test_request, 'origin_institution')
+                    and lab_test_request.origin_institution):
+                sample.origin_institution = lab_test_request.origin_institution
+            samples.append(sample)
+        Sample.save(samples)
+
+        # Cambiar el estado de los lab test requests a 'ordered'
+        if to_process:
+            LabTestRequest.write(to_process, {
+                'state': 'ordered',
+            })
+
+        lines = ['Workflow samples created: %s' % len(samples)]
+        if errors:
+            lines.append('Requests skipped: %s' % len(errors))
+            lines.extend('%s: %s' % e for e in errors)
+        self.result.summary = '\n'.join(lines)
+        return 'result'
 
-        return 'end'
\ No newline at end of file
+    def default_result(self, fields):
+        return {
+            'summary': self.result.summary,
+            }
@@ -1,19 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from trytond.model import ModelView, ModelSQL, fields
+from trytond.model import ModelView, ModelSQL, Index, Unique, fields
 from trytond.pool import Pool
 from trytond.pyson import Eval, Bool
 from trytond.exceptions import UserWarning
+from trytond.tools import grouped_slice
 from datetime import datetime
 
-__all__ = ['GnuHealthLabHistopathology', 'GnuHealthLabHistopathologyAntibody']
+from .health_lab_workflow import WorkflowProcessMixin
+from .instrumentation import instrument
 
+__all__ = ['GnuHealthLabHistopathology', 'GnuHealthLabHistopathologyAntibody',
+           'GnuHealthLabHistopathologyCassette', 'GnuHealthLabHistopathologySlide']
 
-class GnuHealthLabHistopathology(ModelSQL, ModelView):
+CASSETTE_STATES = [
+    ('grossed', 'Grossed'),
+    ('embedded', 'Embedded'),
+    ('sectioned', 'Sectioned'),
+    ('archived', 'Archived'),
+]
+
+SLIDE_STATES = [
+    ('pending', 'Pending'),
+    ('cut', 'Cut'),
+    ('stained', 'Stained'),
+    ('archived', 'Archived'),
+]
+
+# Acciones de escaneo de bloques: modelo afectado, estados desde los que se
+# permite y estado final. Los cassettes escaneados en una acción de
+# portaobjetos se aplican a todos sus portaobjetos
+BLOCK_SCAN_ACTIONS = {
+    'embed': ('cassette', ['grossed'], 'embedded'),
+    'cut': ('slide', ['pending'], 'cut'),
+    'stain': ('slide', ['cut'], 'stained'),
+    'archive_cassette': ('cassette', ['embedded', 'sectioned'], 'archived'),
+    'archive_slide': ('slide', ['stained'], 'archived'),
+}
+
+
+class GnuHealthLabHistopathology(WorkflowProcessMixin, ModelSQL, ModelView):
     'Lab Histopathology Process'
     __name__ = 'gnuhealth.lab.histopathology'
     
+    _workflow_specialty = 'histopathology'
+    _active_process_warning = ('histopathology_exists',
+        'An active histopathology process already exists for this sample.')
+    
     # Relación con la muestra del workflow
     workflow_sample = fields.Many2One('gnuhealth.lab.workflow.sample', 
         'Workflow Sample', required=True, ondelete='CASCADE',
@@ -21,10 +55,11 @@ class GnuHealthLabHistopathology(ModelSQL, ModelView):
         help='Sample being processed in histopathology')
     
     # Información básica (campos función desde workflow_sample)
-    name = fields.Function(fields.Char('Order Number'), 'get_sample_info')
+    name = fields.Function(fields.Char('Order Number'), 'get_sample_info', searcher='search_sample_info')
     patient = fields.Function(fields.Many2One('gnuhealth.patient', 'Patient'), 
-        'get_sample_info')
-    sample_type = fields.Function(fields.Char('Sample Type'), 'get_sample_info')
+        'get_sample_info', searcher='search_sample_info')
+    sample_type = fields.Function(fields.Char('Sample Type'), 'get_sample_info',
+        searcher='search_sample_info')
     
     # Tipo de estudio histopatológico
     study_type = fields.Selection([
@@ -43,7 +78,9 @@ class GnuHealthLabHistopathology(ModelSQL, ModelView):
     
     number_of_cuts = fields.Integer('Number of Cuts',
         states={'invisible': Eval('study_type').in_(['cytology'])},
-        depends=['study_type'])
+        depends=['study_type'],
+        help='Sections cut from each cassette; one slide is created per '
+        'section when macroscopy is completed')
     
     number_of_cassettes = fields.Integer('Number of Cassettes',
         states={'invisible': Eval('study_type').in_(['cytology'])},
@@ -51,6 +88,16 @@ class GnuHealthLabHistopathology(ModelSQL, ModelView):
     
     macroscopy_observations = fields.Text('Macroscopy Observations')
     
+    # Cassettes y portaobjetos generados al completar la macroscopía
+    cassettes = fields.One2Many('gnuhealth.lab.histopathology.cassette',
+        'histopathology', 'Cassettes', readonly=True,
+        states={'invisible': Eval('study_type').in_(['cytology'])},
+        depends=['study_type'])
+    slides = fields.One2Many('gnuhealth.lab.histopathology.slide',
+        'histopathology', 'Slides', readonly=True,
+        states={'invisible': Eval('study_type').in_(['cytology'])},
+        depends=['study_type'])
+    
     # SECCIÓN 2: Procesamiento
     processing_date = fields.DateTime('Processing Date',
         states={'invisible': Eval('study_type').in_(['cytology'])},
@@ -140,25 +187,22 @@ class GnuHealthLabHistopathology(ModelSQL, ModelView):
     def default_state():
         return 'draft'
     
-    def get_sample_info(self, name):
+    @classmethod
+    @instrument
+    def get_sample_info(cls, records, names):
         """Obtiene información de la muestra del workflow"""
-        if self.workflow_sample:
-            if name == 'name':
-                return self.workflow_sample.name
-            elif name == 'patient':
-                return self.workflow_sample.patient.id if self.workflow_sample.patient else None
-            elif name == 'sample_type':
-                # Retornar la descripción del tipo de muestra
-                if self.workflow_sample.sample_type:
-                    # Obtener la selección del modelo de workflow
-                    selection = self.workflow_sample.fields_get(['sample_type'])['sample_type']['selection']
-                    for code, desc in selection:
-                        if code == self.workflow_sample.sample_type:
-                            return desc
-                return ''
-        return None
+        return Pool().get('gnuhealth.lab.workflow.sample'
+            ).get_process_sample_info(cls, records, names)
+    
+    @classmethod
+    def search_sample_info(cls, name, clause):
+        """Searcher de los campos de la muestra (número de orden, paciente
+        y tipo de muestra)"""
+        return Pool().get('gnuhealth.lab.workflow.sample'
+            ).search_process_sample_info(name, clause)
     
     @classmethod
+    @instrument
     @ModelView.button
     def start_macroscopy(cls, tests):
         cls.write(tests, {
@@ -166,12 +210,14 @@ class GnuHealthLabHistopathology(ModelSQL, ModelView):
             'macroscopy_date': datetime.now(),
         })
         # Actualizar el estado de la muestra a 'processing' si no lo está
-        for test in tests:
-            if test.workflow_sample.state == 'received':
-                Pool().get('gnuhealth.lab.workflow.sample').write(
-                    [test.workflow_sample], {'state': 'processing'})
+        samples = list({t.workflow_sample for t in tests
+                if t.workflow_sample.state == 'received'})
+        if samples:
+            Pool().get('gnuhealth.lab.workflow.sample').write(
+                samples, {'state': 'processing'})
     
     @classmethod
+    @instrument
     @ModelView.button
     def complete_macroscopy(cls, tests):
         # Validar que los campos requeridos estén llenos antes de completar
@@ -184,110 +230,256 @@ class GnuHealthLabHistopathology(ModelSQL, ModelView):
                     raise UserWarning('missing_cassettes',
                         'Number of cassettes is required to complete macroscopy.')
         
-        # CORRECCIÓN: Solo establecer processing_date si no existe
-        update_values = {'state': 'processing'}
-        for test in tests:
-            if not test.processing_date:
-                update_values['processing_date'] = datetime.now()
-                break
-        
-        cls.write(tests, update_values)
+        cls._write_stage(tests, 'processing', ['processing_date'])
+        cls.create_blocks(tests)
     
     @classmethod
+    @instrument
     @ModelView.button
     def complete_processing(cls, tests):
-        # CORRECCIÓN: Solo establecer inclusion_date si no existe
-        update_values = {'state': 'cutting'}
-        for test in tests:
-            if not test.inclusion_date:
-                update_values['inclusion_date'] = datetime.now()
-                break
-        
-        cls.write(tests, update_values)
+        cls._write_stage(tests, 'cutting', ['inclusion_date'])
     
     @classmethod
+    @instrument
     @ModelView.button
     def complete_cutting(cls, tests):
-        # CORRECCIÓN: Solo establecer cutting_date si no existe
-        update_values = {'state': 'staining'}
-        for test in tests:
-            if not test.cutting_date:
-                update_values['cutting_date'] = datetime.now()
-                break
-        
-        cls.write(tests, update_values)
+        cls._write_stage(tests, 'staining', ['cutting_date'])
     
     @classmethod
+    @instrument
     @ModelView.button
     def complete_staining(cls, tests):
-        # CORRECCIÓN: Solo establecer fechas si no existen
-        update_values = {'state': 'completed'}
-        
-        for test in tests:
-            if not test.staining_date:
-                update_values['staining_date'] = datetime.now()
-            if not test.delivery_date:
-                update_values['delivery_date'] = datetime.now()
-            
-            # MEJORA 1: Si es citología, copiar diagnóstico a health_lab
-            if test.study_type == 'cytology' and test.diagnosis:
-                cls._copy_diagnosis_to_lab_result(test)
-            break
-        
-        cls.write(tests, update_values)
+        # MEJORA 1: Si es citología, copiar diagnóstico a health_lab
+        cls._copy_diagnosis_to_lab_result(tests)
+        cls._write_stage(tests, 'completed',
+            ['staining_date', 'delivery_date'])
+        Pool().get('gnuhealth.lab.workflow.sample').complete_finished(
+            [t.workflow_sample.id for t in tests])
     
     @classmethod
+    @instrument
     @ModelView.button
     def complete_process(cls, tests):
-        # CORRECCIÓN: Solo establecer delivery_date si no existe
-        update_values = {'state': 'completed'}
-        
-        for test in tests:
-            if not test.delivery_date:
-                update_values['delivery_date'] = datetime.now()
-            
-            # MEJORA 1: Si es citología, copiar diagnóstico a health_lab
-            if test.study_type == 'cytology' and test.diagnosis:
-                cls._copy_diagnosis_to_lab_result(test)
-            break
-        
-        cls.write(tests, update_values)
+        # MEJORA 1: Si es citología, copiar diagnóstico a health_lab
+        cls._copy_diagnosis_to_lab_result(tests)
+        cls._write_stage(tests, 'completed', ['delivery_date'])
+        Pool().get('gnuhealth.lab.workflow.sample').complete_finished(
+            [t.workflow_sample.id for t in tests])
     
     @classmethod
+    @instrument
     @ModelView.button
     def cancel(cls, tests):
         cls.write(tests, {
             'state': 'cancelled',
         })
+        Pool().get('gnuhealth.lab.workflow.sample').complete_finished(
+            [t.workflow_sample.id for t in tests])
     
     @classmethod
-    def _copy_diagnosis_to_lab_result(cls, histopathology_process):
-        """MEJORA 1: Copia el diagnóstico de citología al resultado de laboratorio"""
+    def create_blocks(cls, tests):
+        """Genera los cassettes y portaobjetos de los procesos con un único
+        create() por modelo; se omiten los procesos que ya tienen cassettes"""
+        pool = Pool()
+        Cassette = pool.get('gnuhealth.lab.histopathology.cassette')
+        Slide = pool.get('gnuhealth.lab.histopathology.slide')
+        
+        tests = [t for t in tests
+            if t.study_type != 'cytology' and t.number_of_cassettes]
+        existing = set()
+        for sub_tests in grouped_slice(tests):
+            existing.update(c.histopathology.id for c in Cassette.search([
+                        ('histopathology', 'in', [t.id for t in sub_tests]),
+                        ]))
+        tests = [t for t in tests if t.id not in existing]
+        if not tests:
+            return []
+        
+        cassettes = Cassette.create([{
+                    'histopathology': test.id,
+                    'number': number,
+                    'barcode': Cassette.format_barcode(test.id, number),
+                    } for test in tests
+                for number in range(1, test.number_of_cassettes + 1)])
+        
+        cuts = {t.id: max(t.number_of_cuts or 1, 1) for t in tests}
+        Slide.create([{
+                    'cassette': cassette.id,
+                    'histopathology': cassette.histopathology.id,
+                    'number': number,
+                    'barcode': Slide.format_barcode(cassette.barcode, number),
+                    } for cassette in cassettes
+                for number in range(1, cuts[cassette.histopathology.id] + 1)])
+        return cassettes
+    
+    @classmethod
+    def apply_block_scans(cls, action, barcodes):
+        """Aplica una acción de escaneo a una serie de códigos de cassettes o
+        portaobjetos y avanza los procesos cuyos bloques quedaron todos en la
+        etapa siguiente. Devuelve los códigos aplicados, los desconocidos y
+        los que no están en un estado válido"""
+        pool = Pool()
+        Cassette = pool.get('gnuhealth.lab.histopathology.cassette')
+        Slide = pool.get('gnuhealth.lab.histopathology.slide')
+        if action not in BLOCK_SCAN_ACTIONS:
+            raise ValueError('Unknown block scan action: %s' % action)
+        target, from_states, to_state = BLOCK_SCAN_ACTIONS[action]
+        
+        # Quitar espacios y escaneos repetidos conservando el orden
+        barcodes = list(dict.fromkeys(
+                b.strip() for b in barcodes if b and b.strip()))
+        cassettes, slides = {}, {}
+        for sub_barcodes in grouped_slice(barcodes):
+            sub_barcodes = list(sub_barcodes)
+            cassettes.update((c.barcode, c) for c in Cassette.search([
+                        ('barcode', 'in', sub_barcodes),
+                        ]))
+            slides.update((s.barcode, s) for s in Slide.search([
+                        ('barcode', 'in', sub_barcodes),
+                        ]))
+        
+        # Portaobjetos de los cassettes escaneados en acciones de portaobjetos
+        cassette_slides = {}
+        if target == 'slide':
+            scanned = [c.id for c in cassettes.values()]
+            for sub_ids in grouped_slice(scanned):
+                for slide in Slide.search([
+                            ('cassette', 'in', list(sub_ids)),
+                            ]):
+                    cassette_slides.setdefault(
+                        slide.cassette.id, []).append(slide)
+        
+        report = {'done': [], 'unknown': [], 'invalid': []}
+        to_write = {}
+        for barcode in barcodes:
+            if target == 'slide' and barcode in cassettes:
+                records = cassette_slides.get(cassettes[barcode].id, [])
+            elif target == 'slide' and barcode in slides:
+                records = [slides[barcode]]
+            elif target == 'cassette' and barcode in cassettes:
+                records = [cassettes[barcode]]
+            elif barcode in cassettes or barcode in slides:
+                report['invalid'].append(barcode)
+                continue
+            else:
+                report['unknown'].append(barcode)
+                continue
+            records = [r for r in records if r.state in from_states]
+            if not records:
+                report['invalid'].append(barcode)
+                continue
+            report['done'].append(barcode)
+            to_write.update((r.id, r) for r in records)
+        
+        if to_write:
+            Model = Cassette if target == 'cassette' else Slide
+            records = list(to_write.values())
+            Model.write(records, {
+                    'state': to_state,
+                    'state_date': datetime.now(),
+                    })
+            # El cassette queda seccionado con el primer corte
+            sectioned = list({r.cassette for r in records
+                    if action == 'cut' and r.cassette.state == 'embedded'})
+            if sectioned:
+                Cassette.write(sectioned, {
+                        'state': 'sectioned',
+                        'state_date': datetime.now(),
+                        })
+            cls._advance_from_blocks(action,
+                {r.histopathology.id for r in records})
+        return report
+    
+    @classmethod
+    def _advance_from_blocks(cls, action, test_ids):
+        """Completa la etapa de los procesos cuyos bloques ya la terminaron:
+        procesamiento cuando todos los cassettes están incluidos y corte
+        cuando todos los portaobjetos están cortados. La tinción no completa
+        el proceso porque requiere el diagnóstico"""
+        pool = Pool()
+        Cassette = pool.get('gnuhealth.lab.histopathology.cassette')
+        Slide = pool.get('gnuhealth.lab.histopathology.slide')
+        if action == 'embed':
+            Model, pending, state, button = (
+                Cassette, 'grossed', 'processing', cls.complete_processing)
+        elif action == 'cut':
+            Model, pending, state, button = (
+                Slide, 'pending', 'cutting', cls.complete_cutting)
+        else:
+            return
+        
+        test_ids = list(test_ids)
+        waiting = set()
+        for sub_ids in grouped_slice(test_ids):
+            waiting.update(r.histopathology.id for r in Model.search([
+                        ('histopathology', 'in', list(sub_ids)),
+                        ('state', '=', pending),
+                        ]))
+        tests = [t for t in cls.browse([i for i in test_ids
+                    if i not in waiting]) if t.state == state]
+        if tests:
+            button(tests)
+    
+    @classmethod
+    def _write_stage(cls, tests, state, date_fields):
+        """Pasa los procesos a state completando solo las fechas vacías de
+        cada uno; agrupa por fechas faltantes y hace un único write()"""
+        now = datetime.now()
+        groups = {}
+        for test in tests:
+            missing = tuple(f for f in date_fields if not getattr(test, f))
+            groups.setdefault(missing, []).append(test)
+        
+        args = []
+        for missing, records in groups.items():
+            values = {'state': state}
+            values.update((f, now) for f in missing)
+            args.extend([records, values])
+        if args:
+            cls.write(*args)
+    
+    @classmethod
+    def _copy_diagnosis_to_lab_result(cls, tests):
+        """MEJORA 1: Copia el diagnóstico de citología al resultado de
+        laboratorio de todos los procesos con una sola búsqueda"""
+        LabTestResult = Pool().get('gnuhealth.lab.test.result')
+        
+        diagnoses = {}
+        for test in tests:
+            lab_result = test.workflow_sample.lab_test
+            if (test.study_type == 'cytology' and test.diagnosis
+                    and lab_result):
+                diagnoses[lab_result.id] = test.diagnosis
+        if not diagnoses:
+            return
+        
         try:
-            # Obtener el Lab Result asociado
-            lab_result = histopathology_process.workflow_sample.lab_test
+            # Resultados existentes con el nombre 'Diagnosis' o 'Diagnóstico'
+            existing = LabTestResult.search([
+                ('lab_test', 'in', list(diagnoses.keys())),
+                ('analyte', 'in', ['Diagnosis', 'Diagnóstico',
+                        'Cytological Diagnosis']),
+            ])
             
-            if lab_result and histopathology_process.diagnosis:
-                # Buscar si existe un resultado con el nombre 'Diagnosis' o 'Diagnóstico'
-                LabTestResult = Pool().get('gnuhealth.lab.test.result')
-                existing_result = LabTestResult.search([
-                    ('lab_test', '=', lab_result.id),
-                    ('analyte', 'in', ['Diagnosis', 'Diagnóstico', 'Cytological Diagnosis'])
-                ])
-                
-                if existing_result:
-                    # Actualizar resultado existente
-                    LabTestResult.write(existing_result, {
-                        'result': histopathology_process.diagnosis
-                    })
-                else:
-                    # Crear nuevo resultado
-                    new_result = LabTestResult()
-                    new_result.lab_test = lab_result
-                    new_result.analyte = 'Cytological Diagnosis'
-                    new_result.result = histopathology_process.diagnosis
-                    new_result.save()
-                    
+            # Actualizar resultados existentes
+            to_write = {}
+            for result in existing:
+                diagnosis = diagnoses[result.lab_test.id]
+                to_write.setdefault(diagnosis, []).append(result)
+            args = []
+            for diagnosis, results in to_write.items():
+                args.extend([results, {'result': diagnosis}])
+            if args:
+                LabTestResult.write(*args)
+            
+            # Crear los que faltan
+            found = {r.lab_test.id for r in existing}
+            LabTestResult.create([{
+                        'lab_test': lab_id,
+                        'analyte': 'Cytological Diagnosis',
+                        'result': diagnosis,
+                        } for lab_id, diagnosis in diagnoses.items()
+                    if lab_id not in found])
         except Exception as e:
             # Log el error pero no interrumpir el proceso
             import logging
@@ -295,23 +487,12 @@ class GnuHealthLabHistopathology(ModelSQL, ModelView):
     
     @classmethod
     def create(cls, vlist):
-        """Override create para validaciones y flujo especial de citología"""
+        """Override create para el flujo especial de citología"""
+        vlist = [v.copy() for v in vlist]
         for values in vlist:
-            # Verificar que no exista otro proceso activo para la misma muestra
-            if 'workflow_sample' in values:
-                existing = cls.search([
-                    ('workflow_sample', '=', values['workflow_sample']),
-                    ('state', 'in', ['draft', 'macroscopy', 'processing', 
-                                     'cutting', 'staining']),
-                ])
-                if existing:
-                    raise UserWarning('histopathology_exists',
-                        'An active histopathology process already exists for this sample.')
-            
             # Si es citología, saltar directamente a 'cutting'
             if values.get('study_type') == 'cytology':
                 values['state'] = 'cutting'
-        
         return super(GnuHealthLabHistopathology, cls).create(vlist)
 
 
@@ -363,4 +544,102 @@ class GnuHealthLabHistopathologyAntibody(ModelSQL, ModelView):
     
     @staticmethod
     def default_antibody_type():
-        return 'primary'
\ No newline at end of file
+        return 'primary'
+
+
+class GnuHealthLabHistopathologyCassette(ModelSQL, ModelView):
+    'Histopathology Cassette'
+    __name__ = 'gnuhealth.lab.histopathology.cassette'
+    _rec_name = 'barcode'
+    
+    histopathology = fields.Many2One('gnuhealth.lab.histopathology',
+        'Histopathology', required=True, readonly=True, ondelete='CASCADE')
+    
+    number = fields.Integer('Number', required=True, readonly=True)
+    
+    barcode = fields.Char('Barcode', required=True, readonly=True)
+    
+    state = fields.Selection(CASSETTE_STATES, 'State', required=True,
+        readonly=True)
+    state_date = fields.DateTime('State Date', readonly=True,
+        help='Date of the last scan that changed the state')
+    
+    slides = fields.One2Many('gnuhealth.lab.histopathology.slide',
+        'cassette', 'Slides', readonly=True)
+    
+    observations = fields.Text('Observations')
+    
+    @classmethod
+    def __setup__(cls):
+        super(GnuHealthLabHistopathologyCassette, cls).__setup__()
+        cls._order = [('histopathology', 'DESC'), ('number', 'ASC')]
+        t = cls.__table__()
+        # El índice único del código resuelve cualquier bloque a su caso
+        cls._sql_constraints += [
+            ('barcode_uniq', Unique(t, t.barcode),
+                'health_lab_workflow.msg_histopathology_barcode_unique'),
+        ]
+        cls._sql_indexes.update({
+            Index(t,
+                (t.histopathology, Index.Range()),
+                (t.state, Index.Equality())),
+        })
+    
+    @staticmethod
+    def default_state():
+        return 'grossed'
+    
+    @staticmethod
+    def format_barcode(histopathology_id, number):
+        return 'HP%s-%s' % (histopathology_id, number)
+
+
+class GnuHealthLabHistopathologySlide(ModelSQL, ModelView):
+    'Histopathology Slide'
+    __name__ = 'gnuhealth.lab.histopathology.slide'
+    _rec_name = 'barcode'
+    
+    cassette = fields.Many2One('gnuhealth.lab.histopathology.cassette',
+        'Cassette', required=True, readonly=True, ondelete='CASCADE')
+    
+    # Copia del caso del cassette para búsquedas directas por índice
+    histopathology = fields.Many2One('gnuhealth.lab.histopathology',
+        'Histopathology', required=True, readonly=True, ondelete='CASCADE')
+    
+    number = fields.Integer('Number', required=True, readonly=True)
+    
+    barcode = fields.Char('Barcode', required=True, readonly=True)
+    
+    stain = fields.Char('Stain',
+        help='Stain or marker applied to the slide (e.g., H&E, CK7)')
+    
+    state = fields.Selection(SLIDE_STATES, 'State', required=True,
+        readonly=True)
+    state_date = fields.DateTime('State Date', readonly=True,
+        help='Date of the last scan that changed the state')
+    
+    observations = fields.Text('Observations')
+    
+    @classmethod
+    def __setup__(cls):
+        super(GnuHealthLabHistopathologySlide, cls).__setup__()
+        cls._order = [('histopathology', 'DESC'), ('barcode', 'ASC')]
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('barcode_uniq', Unique(t, t.barcode),
+                'health_lab_workflow.msg_histopathology_barcode_unique'),
+        ]
+        cls._sql_indexes.update({
+            Index(t, (t.cassette, Index.Range())),
+            Index(t,
+                (t.histopathology, Index.Range()),
+                (t.state, Index.Equality())),
+        })
+    
+    @staticmethod
+    def default_state():
+        return 'pending'
+    
+    @staticmethod
+    def format_barcode(cassette_barcode, number):
+        return '%s-%s' % (cassette_barcode, number)
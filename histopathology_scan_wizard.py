@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from trytond.model import ModelView, fields
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.pool import Pool
+
+from .instrumentation import instrument
+
+__all__ = ['HistopathologyScanStart', 'HistopathologyScanResult',
+           'HistopathologyScanWizard']
+
+
+class HistopathologyScanStart(ModelView):
+    'Histopathology Block Station - Scan'
+    __name__ = 'gnuhealth.lab.histopathology.scan.start'
+    
+    action = fields.Selection([
+        ('embed', 'Embed Cassettes'),
+        ('cut', 'Cut Slides'),
+        ('stain', 'Stain Slides'),
+        ('archive_cassette', 'Archive Cassettes'),
+        ('archive_slide', 'Archive Slides'),
+    ], 'Action', required=True,
+    help='Stage change applied to every scanned cassette or slide')
+    
+    scans = fields.Text('Scanned Barcodes', required=True,
+        help='One cassette or slide barcode per line; scanning a cassette '
+        'in a slide action applies it to all of its slides')
+    
+    @staticmethod
+    def default_action():
+        return 'embed'
+
+
+class HistopathologyScanResult(ModelView):
+    'Histopathology Block Station - Result'
+    __name__ = 'gnuhealth.lab.histopathology.scan.result'
+    
+    summary = fields.Text('Summary', readonly=True)
+
+
+class HistopathologyScanWizard(Wizard):
+    'Histopathology Block Station'
+    __name__ = 'gnuhealth.lab.histopathology.scan'
+    
+    start = StateView('gnuhealth.lab.histopathology.scan.start',
+        'health_lab_workflow.histopathology_scan_start_form', [
+            Button('Close', 'end', 'tryton-cancel'),
+            Button('Apply', 'apply', 'tryton-ok', default=True),
+        ])
+    apply = StateTransition()
+    result = StateView('gnuhealth.lab.histopathology.scan.result',
+        'health_lab_workflow.histopathology_scan_result_form', [
+            Button('Close', 'end', 'tryton-cancel'),
+            Button('Scan More', 'start', 'tryton-forward', default=True),
+        ])
+    
+    def default_start(self, fields):
+        # Conservar la acción elegida entre lotes de escaneo
+        return {
+            'action': getattr(self.start, 'action', None) or 'embed',
+            'scans': None,
+            }
+    
+    @instrument
+    def transition_apply(self):
+        Histopathology = Pool().get('gnuhealth.lab.histopathology')
+        
+        report = Histopathology.apply_block_scans(
+            self.start.action, self.start.scans.splitlines())
+        
+        lines = ['Barcodes applied: %s' % len(report['done'])]
+        if report['unknown']:
+            lines.append('Unknown barcodes: %s'
+                % ', '.join(report['unknown']))
+        if report['invalid']:
+            lines.append('Cassettes or slides in an invalid state: %s'
+                % ', '.join(report['invalid']))
+        self.result.summary = '\n'.join(lines)
+        return 'result'
+    
+    def default_result(self, fields):
+        return {
+            'summary': self.result.summary,
+            }
@@ -5,7 +5,8 @@ from trytond.model import ModelView, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool
 from trytond.transaction import Transaction
-from trytond.exceptions import UserWarning
+
+from .instrumentation import instrument
 
 __all__ = ['CreateHistopathologyStart', 'CreateHistopathologyWizard']
 
@@ -45,6 +46,7 @@ class CreateHistopathologyWizard(Wizard):
         ])
     create_process = StateTransition()
     
+    @instrument
     def transition_create_process(self):
         pool = Pool()
         WorkflowSample = pool.get('gnuhealth.lab.workflow.sample')
@@ -53,18 +55,8 @@ class CreateHistopathologyWizard(Wizard):
         # Obtener la muestra del workflow actual
         workflow_sample = WorkflowSample(Transaction().context['active_id'])
         
-        # Verificar que no exista un proceso activo
-        existing = Histopathology.search([
-            ('workflow_sample', '=', workflow_sample.id),
-            ('state', 'in', ['draft', 'macroscopy', 'processing', 
-                           'cutting', 'staining']),
-        ])
-        
-        if existing:
-            raise UserWarning('histopathology_exists',
-                'An active histopathology process already exists for this sample.')
-        
-        # Crear el proceso de histopatología
+        # Crear el proceso de histopatología; create() rechaza
+        # un segundo proceso activo para la misma muestra
         histopathology_process = Histopathology()
         histopathology_process.workflow_sample = workflow_sample
         histopathology_process.study_type = self.start.study_type
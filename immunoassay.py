@@ -4,16 +4,47 @@
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool
 from trytond.pyson import Eval, Bool
-from trytond.exceptions import UserWarning
 from datetime import datetime
+import csv
+import io
+import re
+
+from .health_lab_workflow import PROCESS_CLOSED_STATES, WorkflowProcessMixin
+from .instrumentation import instrument
 
 __all__ = ['GnuHealthLabImmunoassay', 'GnuHealthLabImmunoassayAntibody']
 
+# Pocillos de placas de 96 (A-H x 1-12) y 384 (A-P x 1-24)
+WELL_RE = re.compile(r'^([A-P])0*([1-9]|1[0-9]|2[0-4])$')
+
+# Nombres de columna aceptados en los CSV de los lectores de placas
+PLATE_COLUMNS = {
+    'well': ['well', 'well id', 'position', 'pos'],
+    'order': ['order', 'order number', 'sample', 'sample id', 'sample name'],
+    'name': ['analyte', 'antibody', 'antigen', 'assay', 'name'],
+    'value': ['value', 'result', 'concentration', 'conc', 'od', 'signal'],
+    'unit': ['unit', 'units'],
+    'qualitative': ['qualitative', 'interpretation', 'call', 'flag'],
+}
+
+PLATE_QUALITATIVE = {
+    'positive': 'positive', 'pos': 'positive', '+': 'positive',
+    'reactive': 'positive',
+    'negative': 'negative', 'neg': 'negative', '-': 'negative',
+    'non-reactive': 'negative', 'nonreactive': 'negative',
+    'equivocal': 'equivocal', 'eqv': 'equivocal', 'grey zone': 'equivocal',
+    'borderline': 'borderline',
+}
+
 
-class GnuHealthLabImmunoassay(ModelSQL, ModelView):
+class GnuHealthLabImmunoassay(WorkflowProcessMixin, ModelSQL, ModelView):
     'Lab Immunoassay Process'
     __name__ = 'gnuhealth.lab.immunoassay'
     
+    _workflow_specialty = 'immunoassay'
+    _active_process_warning = ('immunoassay_exists',
+        'An active immunoassay process already exists for this sample.')
+    
     # Relación con la muestra del workflow
     workflow_sample = fields.Many2One('gnuhealth.lab.workflow.sample', 
         'Workflow Sample', required=True, ondelete='CASCADE',
@@ -23,8 +54,9 @@ class GnuHealthLabImmunoassay(ModelSQL, ModelView):
     # Información básica (campos función desde workflow_sample)
     name = fields.Function(fields.Char('Order Number'), 'get_sample_info', searcher='search_sample_info')
     patient = fields.Function(fields.Many2One('gnuhealth.patient', 'Patient'), 
-        'get_sample_info')
-    sample_type = fields.Function(fields.Char('Sample Type'), 'get_sample_info')
+        'get_sample_info', searcher='search_sample_info')
+    sample_type = fields.Function(fields.Char('Sample Type'), 'get_sample_info',
+        searcher='search_sample_info')
     
     # Tipo de inmunoensayo
     assay_type = fields.Selection([
@@ -110,54 +142,22 @@ class GnuHealthLabImmunoassay(ModelSQL, ModelView):
     def default_state():
         return 'draft'
     
-    def get_sample_info(self, name):
+    @classmethod
+    @instrument
+    def get_sample_info(cls, records, names):
         """Obtiene información de la muestra del workflow"""
-        if self.workflow_sample:
-            if name == 'name':
-                return self.workflow_sample.name
-            elif name == 'patient':
-                return self.workflow_sample.patient.id if self.workflow_sample.patient else None
-            elif name == 'sample_type':
-                # Retornar la descripción del tipo de muestra
-                if self.workflow_sample.sample_type:
-                    # Obtener la selección del modelo de workflow
-                    selection = self.workflow_sample.fields_get(['sample_type'])['sample_type']['selection']
-                    for code, desc in selection:
-                        if code == self.workflow_sample.sample_type:
-                            return desc
-                return ''
-        return None
-
+        return Pool().get('gnuhealth.lab.workflow.sample'
+            ).get_process_sample_info(cls, records, names)
+    
     @classmethod
     def search_sample_info(cls, name, clause):
-        """
-        Searcher method for the name field (Order Number)
-        """
-        # clause format: ('field_name', 'operator', 'value')
-        field, operator, value = clause
-
-        # Buscar en los registros de workflow_sample relacionados
-        if name == 'name':
-            # Buscar por número de orden en workflow_sample
-            pool = Pool()
-            WorkflowSample = pool.get('gnuhealth.lab.workflow.sample')
-            
-            # Buscar las muestras que coinciden con el criterio
-            workflow_samples = WorkflowSample.search([
-                ('name', operator, value)
-            ])
-            
-            # Retornar los IDs de immunoassay que tienen esas workflow_samples
-            if workflow_samples:
-                workflow_sample_ids = [ws.id for ws in workflow_samples]
-                return [('workflow_sample', 'in', workflow_sample_ids)]
-            else:
-                return [('id', '=', 0)]  # No hay coincidencias
-        else:
-            # Para otros campos, usar búsqueda estándar
-            return [('workflow_sample.name', operator, value)]
+        """Searcher de los campos de la muestra (número de orden, paciente
+        y tipo de muestra)"""
+        return Pool().get('gnuhealth.lab.workflow.sample'
+            ).search_process_sample_info(name, clause)
     
     @classmethod
+    @instrument
     @ModelView.button
     def start_process(cls, tests):
         # CORRECCIÓN: Solo establecer processing_date si no existe
@@ -177,6 +177,7 @@ class GnuHealthLabImmunoassay(ModelSQL, ModelView):
                     [test.workflow_sample], {'state': 'processing'})
     
     @classmethod
+    @instrument
     @ModelView.button
     def complete_process(cls, tests):
         # CORRECCIÓN: Solo establecer delivery_date si no existe
@@ -188,29 +189,18 @@ class GnuHealthLabImmunoassay(ModelSQL, ModelView):
             break
         
         cls.write(tests, update_values)
+        Pool().get('gnuhealth.lab.workflow.sample').complete_finished(
+            [t.workflow_sample.id for t in tests])
     
     @classmethod
+    @instrument
     @ModelView.button
     def cancel(cls, tests):
         cls.write(tests, {
             'state': 'cancelled',
         })
-    
-    @classmethod
-    def create(cls, vlist):
-        """Override create para validaciones"""
-        for values in vlist:
-            # Verificar que no exista otro proceso activo para la misma muestra
-            if 'workflow_sample' in values:
-                existing = cls.search([
-                    ('workflow_sample', '=', values['workflow_sample']),
-                    ('state', 'in', ['draft', 'in_progress']),
-                ])
-                if existing:
-                    raise UserWarning('immunoassay_exists',
-                        'An active immunoassay process already exists for this sample.')
-        
-        return super(GnuHealthLabImmunoassay, cls).create(vlist)
+        Pool().get('gnuhealth.lab.workflow.sample').complete_finished(
+            [t.workflow_sample.id for t in tests])
 
 
 class GnuHealthLabImmunoassayAntibody(ModelSQL, ModelView):
@@ -269,4 +259,159 @@ class GnuHealthLabImmunoassayAntibody(ModelSQL, ModelView):
     
     @staticmethod
     def default_test_type():
-        return 'antibody'
\ No newline at end of file
+        return 'antibody'
+    
+    @classmethod
+    def _plate_well(cls, value):
+        """Normaliza un pocillo (a1, A01 -> A1) o devuelve None si no es
+        válido"""
+        match = WELL_RE.match((value or '').strip().upper())
+        if match:
+            return '%s%s' % match.groups()
+    
+    @classmethod
+    def parse_plate_layout(cls, layout):
+        """Pocillo -> número de orden a partir de líneas 'A1=12345'"""
+        wells = {}
+        for line in (layout or '').splitlines():
+            if '=' not in line:
+                continue
+            well, number = line.split('=', 1)
+            well = cls._plate_well(well)
+            if well and number.strip():
+                wells[well] = number.strip()
+        return wells
+    
+    @classmethod
+    def import_plate(cls, data, test_type='antibody', name=None, unit=None,
+            cutoff=None, layout=None):
+        """Importa el CSV de un lector de placas: resuelve los inmunoensayos
+        activos de todas las órdenes con una sola búsqueda y crea las filas
+        con un único create(). Devuelve las filas creadas y las filas con
+        errores (número de línea, motivo) en lugar de abortar el archivo"""
+        Immunoassay = Pool().get('gnuhealth.lab.immunoassay')
+        wells = cls.parse_plate_layout(layout)
+        report = {'created': [], 'errors': []}
+        
+        # Lectura en flujo del archivo, fila por fila. El separador se toma
+        # de la línea de títulos: con comas decimales el Sniffer confunde
+        # los archivos separados por punto y coma o tabulaciones
+        stream = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig',
+            errors='replace', newline='')
+        header = stream.readline()
+        delimiter = max('\t;,', key=header.count)
+        reader = csv.reader(stream, delimiter=delimiter)
+        
+        columns = {}
+        for index, title in enumerate(
+                next(csv.reader([header], delimiter=delimiter), [])):
+            title = title.strip().lower()
+            for key, aliases in PLATE_COLUMNS.items():
+                if title in aliases and key not in columns:
+                    columns[key] = index
+        if 'value' not in columns and 'qualitative' not in columns:
+            report['errors'].append((1, 'No result column found'))
+            return report
+        if 'well' not in columns and 'order' not in columns:
+            report['errors'].append((1, 'No well or order number column '
+                    'found'))
+            return report
+        
+        def column(row, key):
+            index = columns.get(key)
+            if index is not None and index < len(row):
+                return row[index].strip()
+            return ''
+        
+        rows = []
+        for row in reader:
+            line = reader.line_num + 1
+            if not any(c.strip() for c in row):
+                continue
+            well = column(row, 'well')
+            if 'well' in columns:
+                well = cls._plate_well(well)
+                if not well:
+                    report['errors'].append(
+                        (line, 'Invalid well %r' % column(row, 'well')))
+                    continue
+            number = column(row, 'order') or wells.get(well)
+            if not number:
+                report['errors'].append(
+                    (line, 'No order number for well %s' % well))
+                continue
+            
+            value = column(row, 'value')
+            quantitative = None
+            qualitative = column(row, 'qualitative').lower()
+            if value:
+                try:
+                    quantitative = float(value.replace(',', '.'))
+                except ValueError:
+                    # Algunos lectores exportan el resultado cualitativo en
+                    # la misma columna
+                    if value.lower() in PLATE_QUALITATIVE and not qualitative:
+                        qualitative = value.lower()
+                    else:
+                        report['errors'].append(
+                            (line, 'Invalid value %r' % value))
+                        continue
+            if qualitative:
+                qualitative = PLATE_QUALITATIVE.get(qualitative)
+                if not qualitative:
+                    report['errors'].append((line, 'Invalid qualitative '
+                            'result %r' % column(row, 'qualitative')))
+                    continue
+            elif quantitative is not None and cutoff is not None:
+                qualitative = ('positive' if quantitative >= cutoff
+                    else 'negative')
+            if quantitative is None and not qualitative:
+                report['errors'].append((line, 'Empty result'))
+                continue
+            
+            analyte = column(row, 'name') or name
+            if not analyte:
+                report['errors'].append((line, 'No antibody/antigen name'))
+                continue
+            rows.append((line, number, well, {
+                        'test_type': test_type,
+                        'name': analyte,
+                        'quantitative_result': quantitative,
+                        'qualitative_result': qualitative or None,
+                        'unit': column(row, 'unit') or unit,
+                        'cutoff_value': cutoff,
+                        'observations': 'Well %s' % well if well else None,
+                        }))
+        
+        # Inmunoensayos activos de todas las órdenes de la placa
+        numbers = list({number for _, number, _, _ in rows})
+        processes, ambiguous = {}, set()
+        if numbers:
+            for process in Immunoassay.search([
+                        ('workflow_sample.name', 'in', numbers),
+                        ('state', 'not in', PROCESS_CLOSED_STATES),
+                        ]):
+                number = process.workflow_sample.name
+                if number in ambiguous or number in processes:
+                    # Sin proceso único no se sabe dónde crear la fila
+                    ambiguous.add(number)
+                    processes.pop(number, None)
+                    continue
+                processes[number] = process
+        
+        to_create = []
+        for line, number, well, values in rows:
+            process = processes.get(number)
+            if number in ambiguous:
+                report['errors'].append((line, 'Several active '
+                        'immunoassays for order %s' % number))
+                continue
+            if not process:
+                report['errors'].append((line, 'No active immunoassay for '
+                        'order %s' % number))
+                continue
+            values['immunoassay'] = process.id
+            to_create.append(values)
+        if to_create:
+            report['created'] = cls.create(to_create)
+        return report
\ No newline at end of file
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import ModelView, ModelSQL, Index, Unique, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+
+from .instrumentation import instrument
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ['GnuHealthLabImmunoassayPlate', 'GnuHealthLabImmunoassayPlateWell']
+
+WELL_ROLES = [
+    ('sample', 'Sample'),
+    ('standard', 'Standard'),
+    ('blank', 'Blank'),
+    ('positive_control', 'Positive Control'),
+    ('negative_control', 'Negative Control'),
+]
+
+WELL_FLAGS = [
+    (None, ''),
+    ('ok', 'In Range'),
+    ('below_range', 'Below Curve Range'),
+    ('above_range', 'Above Curve Range'),
+]
+
+
+def logistic(x, params, five=False):
+    """Curva logística de 4 o 5 parámetros (a, b, log c, d[, g]) evaluada
+    sobre todo el vector x"""
+    a, b, log_c, d = params[:4]
+    g = params[4] if five else 1.
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        return d + (a - d) / (1. + (x / np.exp(log_c)) ** b) ** g
+
+
+def inverse_logistic(y, params, five=False):
+    """Concentraciones de todo el vector de señales y; NaN fuera del rango
+    de la curva"""
+    a, b, log_c, d = params[:4]
+    g = params[4] if five else 1.
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        ratio = ((a - d) / (y - d)) ** (1. / g) - 1.
+        return np.exp(log_c) * ratio ** (1. / b)
+
+
+def fit_logistic(x, y, five=False, max_iter=200, tolerance=1e-10):
+    """Ajuste por Levenberg-Marquardt; devuelve los parámetros y el R²"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    order = np.argsort(x)
+    positive = x[x > 0]
+    params = np.array([
+            y[order[0]],
+            1.,
+            np.mean(np.log(positive)) if positive.size else 0.,
+            y[order[-1]],
+            ] + ([1.] if five else []))
+    size = params.size
+
+    def sse(p):
+        residuals = y - logistic(x, p, five)
+        if not np.all(np.isfinite(residuals)):
+            return np.inf
+        return residuals @ residuals
+
+    current = sse(params)
+    damping = 1e-3
+    for _ in range(max_iter):
+        residuals = y - logistic(x, params, five)
+        # Jacobiano por diferencias finitas, una columna por parámetro
+        steps = 1e-6 * np.maximum(np.abs(params), 1.)
+        jacobian = np.empty((x.size, size))
+        for i in range(size):
+            shifted = params.copy()
+            shifted[i] += steps[i]
+            jacobian[:, i] = (logistic(x, shifted, five)
+                - logistic(x, params, five)) / steps[i]
+        normal = jacobian.T @ jacobian
+        gradient = jacobian.T @ residuals
+        try:
+            delta = np.linalg.solve(
+                normal + damping * np.diag(np.diag(normal) + 1e-12),
+                gradient)
+        except np.linalg.LinAlgError:
+            break
+        candidate = params + delta
+        value = sse(candidate)
+        if value < current:
+            improvement = current - value
+            params, current = candidate, value
+            damping = max(damping / 10., 1e-12)
+            if improvement <= tolerance * max(current, 1.):
+                break
+        else:
+            damping *= 10.
+            if damping > 1e12:
+                break
+
+    total = y - y.mean()
+    total = total @ total
+    r_squared = 1. - current / total if total else 1.
+    return params, r_squared
+
+
+class GnuHealthLabImmunoassayPlate(ModelSQL, ModelView):
+    'Immunoassay Plate'
+    __name__ = 'gnuhealth.lab.immunoassay.plate'
+
+    name = fields.Char('Plate', required=True,
+        states={'readonly': Eval('state') == 'computed'},
+        depends=['state'])
+    date = fields.DateTime('Read Date')
+    signal_type = fields.Selection([
+        ('od', 'Optical Density (OD)'),
+        ('rlu', 'Relative Light Units (RLU)'),
+    ], 'Signal', required=True)
+    curve_model = fields.Selection([
+        ('4pl', '4-Parameter Logistic'),
+        ('5pl', '5-Parameter Logistic'),
+    ], 'Curve Model', required=True)
+
+    analyte = fields.Char('Antibody/Antigen Name', required=True,
+        help='Name of the antibody/antigen rows created for sample wells')
+    test_type = fields.Selection([
+        ('antibody', 'Antibody Detection'),
+        ('antigen', 'Antigen Detection'),
+        ('antibody_titer', 'Antibody Titer'),
+    ], 'Test Type', required=True)
+    unit = fields.Char('Unit')
+    cutoff = fields.Float('Cutoff Value',
+        help='Concentrations at or above this value are positive. Without '
+        'a cutoff, controls are checked against the lowest standard')
+
+    wells = fields.One2Many('gnuhealth.lab.immunoassay.plate.well', 'plate',
+        'Wells')
+
+    # Parámetros de la curva ajustada
+    param_a = fields.Float('A (zero response)', readonly=True)
+    param_b = fields.Float('B (slope)', readonly=True)
+    param_c = fields.Float('C (inflection)', readonly=True)
+    param_d = fields.Float('D (infinite response)', readonly=True)
+    param_g = fields.Float('G (asymmetry)', readonly=True)
+    r_squared = fields.Float('R²', digits=(16, 4), readonly=True)
+
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('computed', 'Computed'),
+    ], 'State', readonly=True, required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(GnuHealthLabImmunoassayPlate, cls).__setup__()
+        cls._order = [('date', 'DESC'), ('id', 'DESC')]
+        cls._buttons.update({
+            'compute': {
+                'invisible': ~Eval('wells'),
+                'depends': ['wells'],
+            },
+        })
+
+    @staticmethod
+    def default_signal_type():
+        return 'od'
+
+    @staticmethod
+    def default_curve_model():
+        return '4pl'
+
+    @staticmethod
+    def default_test_type():
+        return 'antibody'
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @classmethod
+    @instrument
+    @ModelView.button
+    def compute(cls, plates):
+        """Ajusta la curva estándar de cada placa, calcula las
+        concentraciones de todos los pocillos en una pasada vectorizada y
+        las escribe en los pocillos, los anticuerpos y los controles"""
+        pool = Pool()
+        Well = pool.get('gnuhealth.lab.immunoassay.plate.well')
+        Antibody = pool.get('gnuhealth.lab.immunoassay.antibody')
+        Immunoassay = pool.get('gnuhealth.lab.immunoassay')
+        if np is None:
+            raise UserError(gettext(
+                    'health_lab_workflow.msg_plate_numpy_missing'))
+
+        plate_values, well_values = [], []
+        antibody_values, new_antibodies = [], []
+        controls = defaultdict(dict)
+        for plate in plates:
+            wells = list(plate.wells)
+            five = plate.curve_model == '5pl'
+            signals = np.array([w.signal if w.signal is not None else np.nan
+                    for w in wells], dtype=float)
+            roles = np.array([w.role for w in wells])
+
+            # Señal corregida por el promedio de los blancos
+            blanks = signals[(roles == 'blank') & ~np.isnan(signals)]
+            if blanks.size:
+                signals = signals - blanks.mean()
+
+            nominal = np.array([w.nominal_concentration
+                    if w.nominal_concentration is not None else np.nan
+                    for w in wells], dtype=float)
+            standards = ((roles == 'standard') & ~np.isnan(signals)
+                & ~np.isnan(nominal))
+            if np.count_nonzero(standards) < (6 if five else 5):
+                raise UserError(gettext(
+                        'health_lab_workflow.msg_plate_not_enough_standards',
+                        plate=plate.rec_name))
+            params, r_squared = fit_logistic(
+                nominal[standards], signals[standards], five=five)
+            if not np.all(np.isfinite(params)):
+                raise UserError(gettext(
+                        'health_lab_workflow.msg_plate_fit_failed',
+                        plate=plate.rec_name))
+
+            # Concentraciones de todos los pocillos de una sola vez
+            concentrations = inverse_logistic(signals, params, five=five)
+            low = nominal[standards].min()
+            high = nominal[standards].max()
+            flags = np.where(np.isnan(concentrations),
+                np.where(np.abs(signals - params[0])
+                    < np.abs(signals - params[3]),
+                    'below_range', 'above_range'),
+                np.where(concentrations < low, 'below_range',
+                    np.where(concentrations > high, 'above_range', 'ok')))
+
+            plate_values.extend([[plate], {
+                        'param_a': float(params[0]),
+                        'param_b': float(params[1]),
+                        'param_c': float(np.exp(params[2])),
+                        'param_d': float(params[3]),
+                        'param_g': float(params[4]) if five else None,
+                        'r_squared': float(r_squared),
+                        'state': 'computed',
+                        }])
+
+            # Sin punto de corte los controles se evalúan contra el estándar
+            # más bajo: el positivo debe cuantificarse y el negativo quedar
+            # por debajo de la curva
+            control_cutoff = plate.cutoff if plate.cutoff is not None else low
+
+            immunoassays = plate.immunoassays
+            for well, concentration, flag in zip(
+                    wells, concentrations, flags):
+                if well.signal is None:
+                    continue
+                concentration = (float(concentration)
+                    if np.isfinite(concentration) else None)
+                well_values.extend([[well], {
+                            'concentration': concentration,
+                            'flag': str(flag),
+                            }])
+                positive = (concentration is not None
+                    and plate.cutoff is not None
+                    and concentration >= plate.cutoff)
+
+                if well.role in ('positive_control', 'negative_control'):
+                    if concentration is not None:
+                        reactive = concentration >= control_cutoff
+                    else:
+                        reactive = flag == 'above_range'
+                    passed = (reactive if well.role == 'positive_control'
+                        else not reactive)
+                    for immunoassay in immunoassays:
+                        current = controls[immunoassay.id].get(
+                            well.role, 'pass')
+                        controls[immunoassay.id][well.role] = (
+                            'pass' if current == 'pass' and passed
+                            else 'fail')
+                elif well.role == 'sample' and well.immunoassay:
+                    values = {
+                        'quantitative_result': concentration,
+                        'unit': plate.unit,
+                        'cutoff_value': plate.cutoff,
+                        }
+                    if concentration is None:
+                        values['interpretation'] = 'indeterminate'
+                    elif plate.cutoff is not None:
+                        values['qualitative_result'] = (
+                            'positive' if positive else 'negative')
+                    if well.antibody:
+                        antibody_values.extend([[well.antibody], values])
+                    else:
+                        values.update({
+                                'immunoassay': well.immunoassay.id,
+                                'test_type': plate.test_type,
+                                'name': plate.analyte,
+                                'observations': 'Plate %s well %s' % (
+                                    plate.name, well.well),
+                                })
+                        new_antibodies.append((well, values))
+
+        # Una escritura por modelo para todas las placas
+        if plate_values:
+            cls.write(*plate_values)
+        if antibody_values:
+            Antibody.write(*antibody_values)
+        if new_antibodies:
+            antibodies = Antibody.create([v for _, v in new_antibodies])
+            for (well, _), antibody in zip(new_antibodies, antibodies):
+                well_values.extend([[well], {'antibody': antibody.id}])
+        if well_values:
+            Well.write(*well_values)
+        if controls:
+            groups = defaultdict(list)
+            for immunoassay_id, values in controls.items():
+                groups[tuple(sorted(values.items()))].append(immunoassay_id)
+            args = []
+            for values, ids in groups.items():
+                args.extend([Immunoassay.browse(ids), dict(values)])
+            Immunoassay.write(*args)
+
+    @property
+    def immunoassays(self):
+        'Inmunoensayos con pocillos de muestra en la placa'
+        return list({w.immunoassay for w in self.wells
+                if w.role == 'sample' and w.immunoassay})
+
+
+class GnuHealthLabImmunoassayPlateWell(ModelSQL, ModelView):
+    'Immunoassay Plate Well'
+    __name__ = 'gnuhealth.lab.immunoassay.plate.well'
+
+    plate = fields.Many2One('gnuhealth.lab.immunoassay.plate', 'Plate',
+        required=True, ondelete='CASCADE')
+    well = fields.Char('Well', required=True, help='Position, e.g. A1')
+    role = fields.Selection(WELL_ROLES, 'Role', required=True)
+
+    immunoassay = fields.Many2One('gnuhealth.lab.immunoassay',
+        'Immunoassay',
+        states={'required': Eval('role') == 'sample',
+            'invisible': Eval('role') != 'sample'},
+        depends=['role'])
+    antibody = fields.Many2One('gnuhealth.lab.immunoassay.antibody',
+        'Antibody/Antigen Row', readonly=True,
+        domain=[('immunoassay', '=', Eval('immunoassay'))],
+        depends=['immunoassay'])
+
+    signal = fields.Float('Signal', digits=(16, 4),
+        help='Raw optical density or RLU read for the well')
+    nominal_concentration = fields.Float('Nominal Concentration',
+        states={'invisible': Eval('role') != 'standard'},
+        depends=['role'])
+
+    concentration = fields.Float('Concentration', digits=(16, 4),
+        readonly=True)
+    flag = fields.Selection(WELL_FLAGS, 'Flag', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(GnuHealthLabImmunoassayPlateWell, cls).__setup__()
+        cls._order = [('plate', 'ASC'), ('well', 'ASC')]
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('plate_well_uniq', Unique(t, t.plate, t.well),
+                'health_lab_workflow.msg_plate_well_unique'),
+            ]
+        cls._sql_indexes.add(
+            Index(t, (t.immunoassay, Index.Range())))
+
+    @staticmethod
+    def default_role():
+        return 'sample'
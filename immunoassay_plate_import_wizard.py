@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from trytond.model import ModelView, fields
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.pool import Pool
+
+from .instrumentation import instrument
+
+__all__ = ['ImmunoassayPlateImportStart', 'ImmunoassayPlateImportResult',
+           'ImmunoassayPlateImportWizard']
+
+
+class ImmunoassayPlateImportStart(ModelView):
+    'Import Immunoassay Plate'
+    __name__ = 'gnuhealth.lab.immunoassay.plate_import.start'
+    
+    file_ = fields.Binary('Plate File', required=True, filename='filename',
+        help='CSV exported by the plate reader (96 or 384 wells)')
+    filename = fields.Char('File Name')
+    
+    test_type = fields.Selection([
+        ('antibody', 'Antibody Detection'),
+        ('antigen', 'Antigen Detection'),
+        ('antibody_titer', 'Antibody Titer'),
+    ], 'Test Type', required=True)
+    
+    name = fields.Char('Antibody/Antigen Name',
+        help='Used for the rows of the file without an analyte column')
+    unit = fields.Char('Unit',
+        help='Used for the rows of the file without a unit column')
+    cutoff = fields.Float('Cutoff Value',
+        help='If set, rows without a qualitative result are classified '
+        'as positive or negative against this value')
+    
+    layout = fields.Text('Plate Layout',
+        help='Order number of each well, one "A1=12345" per line, '
+        'for files without an order number column')
+    
+    @staticmethod
+    def default_test_type():
+        return 'antibody'
+
+
+class ImmunoassayPlateImportResult(ModelView):
+    'Import Immunoassay Plate - Result'
+    __name__ = 'gnuhealth.lab.immunoassay.plate_import.result'
+    
+    summary = fields.Text('Summary', readonly=True)
+
+
+class ImmunoassayPlateImportWizard(Wizard):
+    'Import Immunoassay Plate'
+    __name__ = 'gnuhealth.lab.immunoassay.plate_import'
+    
+    start = StateView('gnuhealth.lab.immunoassay.plate_import.start',
+        'health_lab_workflow.immunoassay_plate_import_start_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+        ])
+    import_ = StateTransition()
+    result = StateView('gnuhealth.lab.immunoassay.plate_import.result',
+        'health_lab_workflow.immunoassay_plate_import_result_form', [
+            Button('Close', 'end', 'tryton-ok', default=True),
+        ])
+    
+    @instrument
+    def transition_import_(self):
+        Antibody = Pool().get('gnuhealth.lab.immunoassay.antibody')
+        
+        report = Antibody.import_plate(self.start.file_,
+            test_type=self.start.test_type, name=self.start.name,
+            unit=self.start.unit, cutoff=self.start.cutoff,
+            layout=self.start.layout)
+        
+        lines = ['Results imported: %s' % len(report['created'])]
+        if report['errors']:
+            lines.append('Rows not imported: %s' % len(report['errors']))
+            lines.extend('  Line %s: %s' % error
+                for error in report['errors'])
+        self.result.summary = '\n'.join(lines)
+        return 'result'
+    
+    def default_result(self, fields):
+        return {
+            'summary': self.result.summary,
+            }
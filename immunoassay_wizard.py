@@ -5,7 +5,8 @@ from trytond.model import ModelView, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool
 from trytond.transaction import Transaction
-from trytond.exceptions import UserWarning
+
+from .instrumentation import instrument
 
 __all__ = ['CreateImmunoassayStart', 'CreateImmunoassayWizard']
 
@@ -48,6 +49,7 @@ class CreateImmunoassayWizard(Wizard):
         ])
     create_process = StateTransition()
     
+    @instrument
     def transition_create_process(self):
         pool = Pool()
         WorkflowSample = pool.get('gnuhealth.lab.workflow.sample')
@@ -56,17 +58,8 @@ class CreateImmunoassayWizard(Wizard):
         # Obtener la muestra del workflow actual
         workflow_sample = WorkflowSample(Transaction().context['active_id'])
         
-        # Verificar que no exista un proceso activo
-        existing = Immunoassay.search([
-            ('workflow_sample', '=', workflow_sample.id),
-            ('state', 'in', ['draft', 'in_progress']),
-        ])
-        
-        if existing:
-            raise UserWarning('immunoassay_exists',
-                'An active immunoassay process already exists for this sample.')
-        
-        # Crear el proceso de inmunoensayo
+        # Crear el proceso de inmunoensayo; create() rechaza
+        # un segundo proceso activo para la misma muestra
         immunoassay_process = Immunoassay()
         immunoassay_process.workflow_sample = workflow_sample
         immunoassay_process.assay_type = self.start.assay_type
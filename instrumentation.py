@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Instrumentación opcional de consultas SQL
+
+Registra la cantidad de sentencias SQL, las filas leídas y el tiempo de los
+botones, transiciones de asistentes y getters de campos función decorados con
+instrument(). Se activa en la configuración de trytond:
+
+    [health_lab_workflow]
+    instrumentation = True
+
+Cada llamada se envía al logger health_lab_workflow.instrumentation como JSON
+y se acumula en un resumen en memoria disponible con summary().
+assert_query_budget() permite fijar un máximo de consultas en los tests.
+
+El conteo envuelve los métodos de la clase de cursor del backend la primera
+vez que se usa counting(); la transacción y su conexión no se reemplazan.
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['instrument', 'counting', 'assert_query_budget', 'summary',
+    'reset', 'enable', 'disable', 'is_enabled']
+
+logger = logging.getLogger(__name__)
+
+_enabled = config.getboolean(
+    'health_lab_workflow', 'instrumentation', default=False)
+_local = threading.local()
+_lock = threading.Lock()
+_summary = {}
+
+
+class QueryStats(object):
+    'Consultas, filas y tiempo de un bloque instrumentado'
+    __slots__ = ('queries', 'rows', 'time')
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.time = 0.
+
+
+def _frames():
+    frames = getattr(_local, 'frames', None)
+    if frames is None:
+        frames = _local.frames = []
+    return frames
+
+
+def _add(queries=0, rows=0):
+    for stats in _frames():
+        stats.queries += queries
+        stats.rows += rows
+
+
+def _count_execute(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        _add(queries=1)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _count_row(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        row = method(self, *args, **kwargs)
+        if row is not None:
+            _add(rows=1)
+        return row
+    return wrapper
+
+
+def _count_rows(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        rows = method(self, *args, **kwargs)
+        _add(rows=len(rows))
+        return rows
+    return wrapper
+
+
+_CURSOR_METHODS = [
+    ('execute', _count_execute),
+    ('executemany', _count_execute),
+    ('fetchone', _count_row),
+    ('__next__', _count_row),
+    ('fetchmany', _count_rows),
+    ('fetchall', _count_rows),
+    ]
+_instrumented = {}
+
+
+def _instrument_cursors(connection):
+    """Envuelve una sola vez los métodos de la clase de cursor del backend.
+    La transacción y su conexión no se modifican; fuera de un bloque
+    counting() los métodos envueltos solo recorren una lista vacía"""
+    cursor = connection.cursor()
+    try:
+        cursor_class = type(cursor)
+    finally:
+        cursor.close()
+    if cursor_class in _instrumented:
+        return _instrumented[cursor_class]
+    with _lock:
+        if cursor_class not in _instrumented:
+            originals = {}
+            try:
+                for name, wrap in _CURSOR_METHODS:
+                    originals[name] = getattr(cursor_class, name)
+                    setattr(cursor_class, name, wrap(originals[name]))
+                instrumented = True
+            except (TypeError, AttributeError):
+                # Cursor implementado en C sin subclase Python
+                for name, method in originals.items():
+                    try:
+                        setattr(cursor_class, name, method)
+                    except (TypeError, AttributeError):
+                        pass
+                instrumented = False
+                logger.warning('Cursors of type %s can not be instrumented',
+                    cursor_class.__name__)
+            _instrumented[cursor_class] = instrumented
+    return _instrumented[cursor_class]
+
+
+@contextmanager
+def counting():
+    """Cuenta las consultas y filas del bloque en el hilo actual; los
+    bloques anidados se incluyen en los externos"""
+    _instrument_cursors(Transaction().connection)
+    stats = QueryStats()
+    frames = _frames()
+    frames.append(stats)
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.time = time.perf_counter() - start
+        frames.remove(stats)
+
+
+def _record(name, stats):
+    with _lock:
+        entry = _summary.setdefault(name, {
+                'calls': 0,
+                'queries': 0,
+                'rows': 0,
+                'time': 0.,
+                'max_queries': 0,
+                })
+        entry['calls'] += 1
+        entry['queries'] += stats.queries
+        entry['rows'] += stats.rows
+        entry['time'] += stats.time
+        entry['max_queries'] = max(entry['max_queries'], stats.queries)
+    logger.info(json.dumps({
+                'operation': name,
+                'queries': stats.queries,
+                'rows': stats.rows,
+                'time': round(stats.time, 6),
+                }))
+
+
+def instrument(func):
+    """Decorador para botones, transiciones y getters: registra consultas,
+    filas y tiempo de cada llamada cuando la instrumentación está activa"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled or Transaction().connection is None:
+            return func(*args, **kwargs)
+        # Modelo, asistente o registro sobre el que se llama
+        name = '%s.%s' % (args[0].__name__, func.__name__)
+        stats = None
+        try:
+            with counting() as stats:
+                return func(*args, **kwargs)
+        finally:
+            # counting() ya cerró el bloque y completó el tiempo
+            if stats is not None:
+                _record(name, stats)
+    return wrapper
+
+
+@contextmanager
+def assert_query_budget(max_queries, message=None):
+    """Falla si el bloque ejecuta más de max_queries sentencias SQL, p. ej.
+
+        with assert_query_budget(5):
+            Sample.read(ids, ['name', 'patient'])
+    """
+    with counting() as stats:
+        yield stats
+    if stats.queries > max_queries:
+        raise AssertionError(message or '%s queries executed, budget is %s'
+            % (stats.queries, max_queries))
+
+
+def summary():
+    """Copia del resumen acumulado por operación"""
+    with _lock:
+        return {name: dict(entry) for name, entry in _summary.items()}
+
+
+def reset():
+    with _lock:
+        _summary.clear()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from trytond.pool import PoolMeta
+
+__all__ = ['Cron']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+    
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.extend([
+            ('gnuhealth.lab.workflow.sample|generate_lab_reports',
+                'Generate Lab Test Reports for Completed Samples'),
+            ('gnuhealth.lab.workflow.sample|auto_complete_finished',
+                'Complete Samples with All Processes Finished'),
+        ])
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from trytond.model import ModelView, fields
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.pool import Pool
+
+from .instrumentation import instrument
+
+__all__ = ['LabStationStart', 'LabStationResult', 'LabStationWizard']
+
+
+class LabStationStart(ModelView):
+    'Lab Station - Scan Samples'
+    __name__ = 'gnuhealth.lab.workflow.station.start'
+    
+    action = fields.Selection([
+        ('collect', 'Collect'),
+        ('receive', 'Receive at Lab'),
+        ('process', 'Start Processing'),
+    ], 'Action', required=True,
+    help='State change applied to every scanned sample')
+    
+    scans = fields.Text('Scanned Order Numbers', required=True,
+        help='One order number per line, as read by the barcode scanner')
+    
+    @staticmethod
+    def default_action():
+        return 'receive'
+
+
+class LabStationResult(ModelView):
+    'Lab Station - Result'
+    __name__ = 'gnuhealth.lab.workflow.station.result'
+    
+    summary = fields.Text('Summary', readonly=True)
+
+
+class LabStationWizard(Wizard):
+    'Lab Station'
+    __name__ = 'gnuhealth.lab.workflow.station'
+    
+    start = StateView('gnuhealth.lab.workflow.station.start',
+        'health_lab_workflow.lab_station_start_form', [
+            Button('Close', 'end', 'tryton-cancel'),
+            Button('Apply', 'apply', 'tryton-ok', default=True),
+        ])
+    apply = StateTransition()
+    result = StateView('gnuhealth.lab.workflow.station.result',
+        'health_lab_workflow.lab_station_result_form', [
+            Button('Close', 'end', 'tryton-cancel'),
+            Button('Scan More', 'start', 'tryton-forward', default=True),
+        ])
+    
+    def default_start(self, fields):
+        # Conservar la acción elegida entre lotes de escaneo
+        return {
+            'action': getattr(self.start, 'action', None) or 'receive',
+            'scans': None,
+            }
+    
+    @instrument
+    def transition_apply(self):
+        WorkflowSample = Pool().get('gnuhealth.lab.workflow.sample')
+        
+        report = WorkflowSample.apply_station_scans(
+            self.start.action, self.start.scans.splitlines())
+        
+        lines = ['Samples updated: %s' % len(report['done'])]
+        if report['unknown']:
+            lines.append('Unknown order numbers: %s'
+                % ', '.join(report['unknown']))
+        if report['invalid']:
+            lines.append('Samples in an invalid state: %s'
+                % ', '.join(report['invalid']))
+        self.result.summary = '\n'.join(lines)
+        return 'result'
+    
+    def default_result(self, fields):
+        return {
+            'summary': self.result.summary,
+            }
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['GnuHealthLabTestType', 'GnuHealthLabTestCritearea']
+
+
+class GnuHealthLabTestType(metaclass=PoolMeta):
+    __name__ = 'gnuhealth.lab.test_type'
+    
+    # Plantilla de criterios lista para crear, por tipo de examen
+    _criteria_template = Cache('gnuhealth.lab.test_type.criteria_template')
+    
+    @classmethod
+    def get_criteria_template(cls, test_type):
+        """Valores de los criterios del tipo de examen para un nuevo reporte"""
+        template = cls._criteria_template.get(test_type.id)
+        if template is None:
+            template = []
+            for critearea in test_type.critearea:
+                template.append({
+                    'name': critearea.name,
+                    'code': critearea.code,
+                    'sequence': critearea.sequence,
+                    'lower_limit': critearea.lower_limit,
+                    'upper_limit': critearea.upper_limit,
+                    'normal_range': critearea.normal_range,
+                    'units': critearea.units and critearea.units.id,
+                })
+            cls._criteria_template.set(test_type.id, template)
+        # Copias para que quien llama no altere la plantilla en caché
+        return [values.copy() for values in template]
+    
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        template_changed = any(
+            'critearea' in values for _, values in zip(actions, actions))
+        super(GnuHealthLabTestType, cls).write(*args)
+        if template_changed:
+            cls._criteria_template.clear()
+    
+    @classmethod
+    def delete(cls, test_types):
+        super(GnuHealthLabTestType, cls).delete(test_types)
+        cls._criteria_template.clear()
+
+
+class GnuHealthLabTestCritearea(metaclass=PoolMeta):
+    __name__ = 'gnuhealth.lab.test.critearea'
+    
+    # Los criterios de los reportes usan el mismo modelo; sólo las líneas
+    # que pertenecen a un tipo de examen invalidan la plantilla
+    
+    @classmethod
+    def _clear_criteria_template(cls):
+        Pool().get('gnuhealth.lab.test_type')._criteria_template.clear()
+    
+    @classmethod
+    def create(cls, vlist):
+        records = super(GnuHealthLabTestCritearea, cls).create(vlist)
+        if any(v.get('test_type_id') for v in vlist):
+            cls._clear_criteria_template()
+        return records
+    
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        template_changed = False
+        for records, values in zip(actions, actions):
+            if ('test_type_id' in values
+                    or any(r.test_type_id for r in records)):
+                template_changed = True
+        super(GnuHealthLabTestCritearea, cls).write(*args)
+        if template_changed:
+            cls._clear_criteria_template()
+    
+    @classmethod
+    def delete(cls, records):
+        template_changed = any(r.test_type_id for r in records)
+        super(GnuHealthLabTestCritearea, cls).delete(records)
+        if template_changed:
+            cls._clear_criteria_template()
@@ -1,19 +1,47 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from trytond.model import ModelView, ModelSQL, fields
+from trytond.cache import Cache
+from trytond.model import ModelView, ModelSQL, Unique, fields
 from trytond.pool import Pool
 from trytond.pyson import Eval, Bool
-from trytond.exceptions import UserWarning
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
 from datetime import datetime
+import csv
+import io
 
-__all__ = ['GnuHealthLabMolecularBiology', 'GnuHealthLabMolecularBiologyAntibody']
+from .health_lab_workflow import PROCESS_CLOSED_STATES, WorkflowProcessMixin
+from .instrumentation import instrument
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-class GnuHealthLabMolecularBiology(ModelSQL, ModelView):
+__all__ = ['GnuHealthLabMolecularBiology', 'GnuHealthLabMolecularBiologyAntibody',
+           'GnuHealthLabMolecularBiologyCtRule']
+
+# Nombres de columna de las exportaciones de termocicladores (QuantStudio,
+# CFX, LightCycler...)
+QPCR_COLUMNS = {
+    'order': ['sample name', 'sample', 'sample id', 'name'],
+    'target': ['target name', 'target', 'detector', 'gene', 'assay'],
+    'ct': ['ct', 'cq', 'crt', 'cp', 'ct mean', 'cq mean'],
+}
+
+# Valores de Ct que indican que el objetivo no amplificó
+QPCR_UNDETERMINED = {'', 'undetermined', 'n/a', 'na', 'nan', 'no ct', '-'}
+
+
+class GnuHealthLabMolecularBiology(WorkflowProcessMixin, ModelSQL, ModelView):
     'Lab Molecular Biology Process'
     __name__ = 'gnuhealth.lab.molecular_biology'
 
+    _workflow_specialty = 'molecular_biology'
+    _active_process_warning = ('molecular_biology_exists',
+        'An active molecular biology process already exists for this sample.')
+
     # Relación con la muestra del workflow
     workflow_sample = fields.Many2One('gnuhealth.lab.workflow.sample',
                                       'Workflow Sample', required=True, ondelete='CASCADE',
@@ -23,8 +51,9 @@ class GnuHealthLabMolecularBiology(ModelSQL, ModelView):
     # Información básica (campos función desde workflow_sample)
     name = fields.Function(fields.Char('Order Number'), 'get_sample_info', searcher='search_sample_info')
     patient = fields.Function(fields.Many2One('gnuhealth.patient', 'Patient'),
-                              'get_sample_info')
-    sample_type = fields.Function(fields.Char('Sample Type'), 'get_sample_info')
+                              'get_sample_info', searcher='search_sample_info')
+    sample_type = fields.Function(fields.Char('Sample Type'), 'get_sample_info',
+                                  searcher='search_sample_info')
 
     # Tipo de análisis molecular
     analysis_type = fields.Selection([
@@ -90,44 +119,22 @@ class GnuHealthLabMolecularBiology(ModelSQL, ModelView):
     def default_state():
         return 'draft'
 
-    def get_sample_info(self, name):
+    @classmethod
+    @instrument
+    def get_sample_info(cls, records, names):
         """Obtiene información de la muestra del workflow"""
-        if self.workflow_sample:
-            if name == 'name':
-                return self.workflow_sample.name
-            elif name == 'patient':
-                return self.workflow_sample.patient.id if self.workflow_sample.patient else None
-            elif name == 'sample_type':
-                if self.workflow_sample.sample_type:
-                    selection = self.workflow_sample.fields_get(['sample_type'])['sample_type']['selection']
-                    for code, desc in selection:
-                        if code == self.workflow_sample.sample_type:
-                            return desc
-                return ''
-        return None
+        return Pool().get('gnuhealth.lab.workflow.sample'
+            ).get_process_sample_info(cls, records, names)
 
     @classmethod
     def search_sample_info(cls, name, clause):
-        """Searcher method for the name field (Order Number)"""
-        field, operator, value = clause
-
-        if name == 'name':
-            pool = Pool()
-            WorkflowSample = pool.get('gnuhealth.lab.workflow.sample')
-
-            workflow_samples = WorkflowSample.search([
-                ('name', operator, value)
-            ])
-
-            if workflow_samples:
-                workflow_sample_ids = [ws.id for ws in workflow_samples]
-                return [('workflow_sample', 'in', workflow_sample_ids)]
-            else:
-                return [('id', '=', 0)]
-        else:
-            return [('workflow_sample.name', operator, value)]
+        """Searcher de los campos de la muestra (número de orden, paciente
+        y tipo de muestra)"""
+        return Pool().get('gnuhealth.lab.workflow.sample'
+            ).search_process_sample_info(name, clause)
 
     @classmethod
+    @instrument
     @ModelView.button
     def start_process(cls, tests):
         cls.write(tests, {
@@ -141,35 +148,25 @@ class GnuHealthLabMolecularBiology(ModelSQL, ModelView):
                     [test.workflow_sample], {'state': 'processing'})
 
     @classmethod
+    @instrument
     @ModelView.button
     def complete_process(cls, tests):
         cls.write(tests, {
             'state': 'completed',
             'delivery_date': datetime.now(),
         })
+        Pool().get('gnuhealth.lab.workflow.sample').complete_finished(
+            [t.workflow_sample.id for t in tests])
 
     @classmethod
+    @instrument
     @ModelView.button
     def cancel(cls, tests):
         cls.write(tests, {
             'state': 'cancelled',
         })
-
-    @classmethod
-    def create(cls, vlist):
-        """Override create para validaciones"""
-        for values in vlist:
-            # Verificar que no exista otro proceso activo para la misma muestra
-            if 'workflow_sample' in values:
-                existing = cls.search([
-                    ('workflow_sample', '=', values['workflow_sample']),
-                    ('state', 'in', ['draft', 'processing']),
-                ])
-                if existing:
-                    raise UserWarning('molecular_biology_exists',
-                                      'An active molecular biology process already exists for this sample.')
-
-        return super(GnuHealthLabMolecularBiology, cls).create(vlist)
+        Pool().get('gnuhealth.lab.workflow.sample').complete_finished(
+            [t.workflow_sample.id for t in tests])
 
 
 class GnuHealthLabMolecularBiologyAntibody(ModelSQL, ModelView):
@@ -225,8 +222,214 @@ class GnuHealthLabMolecularBiologyAntibody(ModelSQL, ModelView):
     pattern = fields.Char('Pattern',
                           help='Pattern description')
 
+    # Valor Ct/Cq de PCR en tiempo real
+    ct_value = fields.Float('Ct/Cq', digits=(16, 2),
+                            help='Cycle threshold; empty when the target did not amplify')
+
     observations = fields.Text('Observations')
 
     @staticmethod
     def default_antibody_type():
         return 'primer'
+
+    @classmethod
+    def interpret_ct(cls, markers, ct_values=None):
+        """Interpreta en una pasada vectorizada los Ct de una corrida según
+        las reglas de corte por objetivo y devuelve los argumentos de un
+        único write(): amplificado si el Ct es menor o igual al corte (o si
+        no hay regla para el objetivo)"""
+        CtRule = Pool().get('gnuhealth.lab.molecular_biology.ct_rule')
+        if np is None:
+            raise UserError(gettext(
+                    'health_lab_workflow.msg_qpcr_numpy_missing'))
+        if ct_values is None:
+            ct_values = [m.ct_value for m in markers]
+        rules = CtRule.get_cutoffs()
+
+        ct = np.array([v if v is not None else np.nan for v in ct_values],
+            dtype=float)
+        cutoff = np.array([rules.get((m.name or '').strip().lower(), np.nan)
+                for m in markers], dtype=float)
+        amplified = ~np.isnan(ct) & (np.isnan(cutoff) | (ct <= cutoff))
+        results = np.where(amplified, 'amplified', 'not_amplified')
+
+        # Un grupo de registros por cada par (Ct, resultado) distinto
+        groups = {}
+        for marker, value, result in zip(markers, ct_values, results):
+            groups.setdefault((value, str(result)), []).append(marker)
+        args = []
+        for (value, result), records in groups.items():
+            args.extend([records, {
+                        'ct_value': value,
+                        'result': result,
+                        }])
+        return args
+
+    @classmethod
+    def import_qpcr_run(cls, data):
+        """Importa la exportación CSV de un termociclador: resuelve los
+        procesos activos de todas las órdenes y sus marcadores con una
+        búsqueda cada uno, crea los marcadores que faltan con un único
+        create() e interpreta y escribe todos los Ct con un único write().
+        Las filas con errores se informan sin abortar el archivo"""
+        MolecularBiology = Pool().get('gnuhealth.lab.molecular_biology')
+        report = {'interpreted': [], 'errors': []}
+
+        # Lectura en flujo; algunos equipos anteponen líneas de encabezado.
+        # El separador se toma de la línea de títulos: con comas decimales
+        # el Sniffer confunde los archivos separados por tabulaciones
+        stream = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig',
+            errors='replace', newline='')
+        columns, header_line = {}, 0
+        for header_line, line in enumerate(stream, 1):
+            delimiter = max('\t;,', key=line.count)
+            titles = [c.strip().lower()
+                for c in next(csv.reader([line], delimiter=delimiter), [])]
+            for key, aliases in QPCR_COLUMNS.items():
+                for index, title in enumerate(titles):
+                    if title in aliases and key not in columns:
+                        columns[key] = index
+            if {'order', 'target', 'ct'} <= set(columns):
+                break
+            columns = {}
+        if not columns:
+            report['errors'].append(
+                (header_line, 'No sample, target and Ct columns found'))
+            return report
+        reader = csv.reader(stream, delimiter=delimiter)
+
+        def column(row, key):
+            index = columns.get(key)
+            if index is not None and index < len(row):
+                return row[index].strip()
+            return ''
+
+        rows = {}
+        for row in reader:
+            line = header_line + reader.line_num
+            if not any(c.strip() for c in row):
+                continue
+            number, target = column(row, 'order'), column(row, 'target')
+            if not number or not target:
+                report['errors'].append(
+                    (line, 'Missing sample name or target'))
+                continue
+            value = column(row, 'ct')
+            if value.lower() in QPCR_UNDETERMINED:
+                ct = None
+            else:
+                try:
+                    ct = float(value.replace(',', '.'))
+                except ValueError:
+                    report['errors'].append(
+                        (line, 'Invalid Ct value %r' % value))
+                    continue
+            # Réplicas: se conserva el menor Ct del objetivo
+            key = (number, target.lower())
+            previous = rows.get(key)
+            if previous and previous[2] is not None and (
+                    ct is None or previous[2] <= ct):
+                continue
+            rows[key] = (line, target, ct)
+
+        # Procesos activos y sus marcadores, una búsqueda cada uno
+        numbers = list({number for number, _ in rows})
+        processes, ambiguous = {}, set()
+        if numbers:
+            for process in MolecularBiology.search([
+                        ('workflow_sample.name', 'in', numbers),
+                        ('state', 'not in', PROCESS_CLOSED_STATES),
+                        ]):
+                number = process.workflow_sample.name
+                if number in ambiguous or number in processes:
+                    # Sin proceso único no se sabe dónde escribir el Ct
+                    ambiguous.add(number)
+                    processes.pop(number, None)
+                    continue
+                processes[number] = process
+        existing = {}
+        if processes:
+            for marker in cls.search([
+                        ('molecular_biology', 'in',
+                            [p.id for p in processes.values()]),
+                        ]):
+                existing.setdefault((marker.molecular_biology.id,
+                        (marker.name or '').strip().lower()), marker)
+
+        markers, ct_values, to_create = [], [], []
+        for (number, target_key), (line, target, ct) in rows.items():
+            process = processes.get(number)
+            if number in ambiguous:
+                report['errors'].append((line, 'Several active molecular '
+                        'biology processes for order %s' % number))
+                continue
+            if not process:
+                report['errors'].append((line, 'No active molecular '
+                        'biology process for order %s' % number))
+                continue
+            marker = existing.get((process.id, target_key))
+            if marker:
+                markers.append(marker)
+                ct_values.append(ct)
+            else:
+                to_create.append(({
+                            'molecular_biology': process.id,
+                            'antibody_type': 'probe',
+                            'name': target,
+                            }, ct))
+        if to_create:
+            markers.extend(cls.create([v for v, _ in to_create]))
+            ct_values.extend(ct for _, ct in to_create)
+
+        if markers:
+            cls.write(*cls.interpret_ct(markers, ct_values))
+        report['interpreted'] = markers
+        return report
+
+
+class GnuHealthLabMolecularBiologyCtRule(ModelSQL, ModelView):
+    'Molecular Biology Ct Cutoff Rule'
+    __name__ = 'gnuhealth.lab.molecular_biology.ct_rule'
+
+    target = fields.Char('Target', required=True,
+                         help='Marker name as exported by the thermocycler')
+    cutoff = fields.Float('Ct Cutoff', digits=(16, 2), required=True,
+                          help='Targets with a Ct at or below this value are amplified')
+
+    # Cortes por objetivo (en minúsculas), compartidos entre procesos
+    _cutoffs = Cache('gnuhealth.lab.molecular_biology.ct_rule.cutoffs')
+
+    @classmethod
+    def __setup__(cls):
+        super(GnuHealthLabMolecularBiologyCtRule, cls).__setup__()
+        cls._order = [('target', 'ASC')]
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('target_uniq', Unique(t, t.target),
+                'health_lab_workflow.msg_ct_rule_target_unique'),
+            ]
+
+    @classmethod
+    def get_cutoffs(cls):
+        cutoffs = cls._cutoffs.get(None)
+        if cutoffs is None:
+            cutoffs = {r.target.strip().lower(): r.cutoff
+                for r in cls.search([])}
+            cls._cutoffs.set(None, cutoffs)
+        return cutoffs
+
+    @classmethod
+    def create(cls, vlist):
+        rules = super(GnuHealthLabMolecularBiologyCtRule, cls).create(vlist)
+        cls._cutoffs.clear()
+        return rules
+
+    @classmethod
+    def write(cls, *args):
+        super(GnuHealthLabMolecularBiologyCtRule, cls).write(*args)
+        cls._cutoffs.clear()
+
+    @classmethod
+    def delete(cls, rules):
+        super(GnuHealthLabMolecularBiologyCtRule, cls).delete(rules)
+        cls._cutoffs.clear()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from trytond.model import ModelView, fields
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.pool import Pool
+
+from .instrumentation import instrument
+
+__all__ = ['MolecularBiologyQpcrImportStart', 'MolecularBiologyQpcrImportResult',
+           'MolecularBiologyQpcrImportWizard']
+
+
+class MolecularBiologyQpcrImportStart(ModelView):
+    'Import qPCR Run'
+    __name__ = 'gnuhealth.lab.molecular_biology.qpcr_import.start'
+
+    file_ = fields.Binary('Run File', required=True, filename='filename',
+        help='CSV results exported by the thermocycler, with sample name, '
+        'target name and Ct/Cq columns')
+    filename = fields.Char('File Name')
+
+
+class MolecularBiologyQpcrImportResult(ModelView):
+    'Import qPCR Run - Result'
+    __name__ = 'gnuhealth.lab.molecular_biology.qpcr_import.result'
+
+    summary = fields.Text('Summary', readonly=True)
+
+
+class MolecularBiologyQpcrImportWizard(Wizard):
+    'Import qPCR Run'
+    __name__ = 'gnuhealth.lab.molecular_biology.qpcr_import'
+
+    start = StateView('gnuhealth.lab.molecular_biology.qpcr_import.start',
+        'health_lab_workflow.molecular_biology_qpcr_import_start_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+        ])
+    import_ = StateTransition()
+    result = StateView('gnuhealth.lab.molecular_biology.qpcr_import.result',
+        'health_lab_workflow.molecular_biology_qpcr_import_result_form', [
+            Button('Close', 'end', 'tryton-ok', default=True),
+        ])
+
+    @instrument
+    def transition_import_(self):
+        Antibody = Pool().get('gnuhealth.lab.molecular_biology.antibody')
+
+        report = Antibody.import_qpcr_run(self.start.file_)
+
+        # Instancias nuevas para leer el resultado ya escrito
+        markers = Antibody.browse(report['interpreted'])
+        amplified = len([m for m in markers if m.result == 'amplified'])
+        lines = [
+            'Markers interpreted: %s' % len(markers),
+            '  Amplified: %s' % amplified,
+            '  Not amplified: %s' % (len(markers) - amplified),
+            ]
+        if report['errors']:
+            lines.append('Rows not imported: %s' % len(report['errors']))
+            lines.extend('  Line %s: %s' % error
+                for error in report['errors'])
+        self.result.summary = '\n'.join(lines)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'summary': self.result.summary,
+            }
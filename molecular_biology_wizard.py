@@ -5,10 +5,21 @@ from trytond.model import ModelView, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool
 from trytond.transaction import Transaction
-from trytond.exceptions import UserWarning
+
+from .instrumentation import instrument
 
 __all__ = ['CreateMolecularBiologyStart', 'CreateMolecularBiologyWizard']
 
+# Tipo de análisis del proceso según el tipo de estudio elegido
+STUDY_ANALYSIS_TYPES = {
+    'pcr_endpoint': 'pcr',
+    'qpcr': 'qpcr',
+    'rt_pcr': 'pcr',
+    'sequencing': 'sequencing',
+    'extraction_only': 'other',
+    'electrophoresis': 'electrophoresis',
+}
+
 
 class CreateMolecularBiologyStart(ModelView):
     'Create Molecular Biology Process'
@@ -46,6 +57,7 @@ class CreateMolecularBiologyWizard(Wizard):
         ])
     create_process = StateTransition()
     
+    @instrument
     def transition_create_process(self):
         pool = Pool()
         WorkflowSample = pool.get('gnuhealth.lab.workflow.sample')
@@ -54,20 +66,12 @@ class CreateMolecularBiologyWizard(Wizard):
         # Obtener la muestra del workflow actual
         workflow_sample = WorkflowSample(Transaction().context['active_id'])
         
-        # Verificar que no exista un proceso activo
-        existing = MolecularBiology.search([
-            ('workflow_sample', '=', workflow_sample.id),
-            ('state', 'in', ['draft', 'in_progress']),
-        ])
-        
-        if existing:
-            raise UserWarning('molecular_exists',
-                'An active molecular biology process already exists for this sample.')
-        
-        # Crear el proceso de biología molecular
+        # Crear el proceso de biología molecular; create() rechaza
+        # un segundo proceso activo para la misma muestra
         molecular_process = MolecularBiology()
         molecular_process.workflow_sample = workflow_sample
-        molecular_process.study_type = self.start.study_type
+        molecular_process.analysis_type = STUDY_ANALYSIS_TYPES[
+            self.start.study_type]
         molecular_process.responsible_professional = self.start.responsible_professional
         molecular_process.observations = self.start.observations
         molecular_process.save()
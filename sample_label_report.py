@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from trytond.pool import Pool
+from trytond.report import Report
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['SampleLabelReport']
+
+
+class SampleLabelReport(Report):
+    'Lab Workflow Sample Labels and Worksheet'
+    __name__ = 'gnuhealth.lab.workflow.sample.label'
+
+    @classmethod
+    def get_context(cls, records, header, data):
+        """Todas las etiquetas en un único documento: los datos se leen con
+        una consulta por lote de ids y el template se compila una sola vez"""
+        context = super(SampleLabelReport, cls).get_context(
+            records, header, data)
+        context['labels'] = cls.get_labels([r.id for r in records])
+        return context
+
+    @classmethod
+    def get_labels(cls, sample_ids):
+        """Datos de etiqueta de las muestras, en el orden recibido"""
+        pool = Pool()
+        Sample = pool.get('gnuhealth.lab.workflow.sample')
+        Lab = pool.get('gnuhealth.lab')
+        Patient = pool.get('gnuhealth.patient')
+        TestType = pool.get('gnuhealth.lab.test_type')
+        Institution = pool.get('gnuhealth.institution')
+        Party = pool.get('party.party')
+        cursor = Transaction().connection.cursor()
+        sample = Sample.__table__()
+        lab = Lab.__table__()
+        patient = Patient.__table__()
+        patient_party = Party.__table__()
+        test_type = TestType.__table__()
+        institution = Institution.__table__()
+        institution_party = Party.__table__()
+
+        sample_types = Sample.get_sample_type_labels()
+        states = dict(Sample.fields_get(['state'])['state']['selection'])
+
+        labels = {}
+        for sub_ids in grouped_slice(sample_ids):
+            cursor.execute(*sample.join(lab, 'LEFT',
+                    condition=sample.lab_test == lab.id
+                    ).join(patient, 'LEFT',
+                    condition=lab.patient == patient.id
+                    ).join(patient_party, 'LEFT',
+                    condition=patient.name == patient_party.id
+                    ).join(test_type, 'LEFT',
+                    condition=lab.test == test_type.id
+                    ).join(institution, 'LEFT',
+                    condition=sample.origin_institution == institution.id
+                    ).join(institution_party, 'LEFT',
+                    condition=institution.name == institution_party.id
+                    ).select(
+                    sample.id, sample.name, sample.sample_type, sample.state,
+                    sample.collection_date, sample.notes,
+                    patient_party.name, patient_party.lastname,
+                    patient_party.ref, test_type.name, test_type.code,
+                    institution_party.name,
+                    where=reduce_ids(sample.id, sub_ids)))
+            for (sample_id, number, sample_type, state, collection_date,
+                    notes, first_name, last_name, puid, test_name, test_code,
+                    institution_name) in cursor:
+                patient_name = ', '.join(
+                    n for n in (last_name, first_name) if n)
+                labels[sample_id] = {
+                    'number': number or '',
+                    # Código 39: el número entre asteriscos
+                    'barcode': '*%s*' % (number or ''),
+                    'sample_type': sample_types.get(sample_type, ''),
+                    'state': states.get(state, ''),
+                    'collection_date': collection_date,
+                    'notes': notes or '',
+                    'patient': patient_name,
+                    'puid': puid or '',
+                    'test': test_name or '',
+                    'test_code': test_code or '',
+                    'institution': institution_name or '',
+                    }
+        return [labels[i] for i in sample_ids if i in labels]
@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import date, datetime, time, timedelta
+from itertools import count
+from unittest.mock import patch
+
+from trytond import backend
+from trytond.exceptions import UserError, UserWarning
+from trytond.modules.health_lab_workflow.immunoassay_plate import (
+    fit_logistic, inverse_logistic, logistic, np)
+from trytond.modules.health_lab_workflow.instrumentation import (
+    assert_query_budget)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+_numbers = count(900000)
+
+
+def create_professional():
+    pool = Pool()
+    Party = pool.get('party.party')
+    HealthProfessional = pool.get('gnuhealth.healthprofessional')
+    party, = Party.create([{
+                'name': 'Test Pathologist',
+                'is_person': True,
+                'is_healthprof': True,
+                }])
+    professional, = HealthProfessional.create([{'name': party.id}])
+    return professional
+
+
+def create_samples(quantity, **values):
+    """Muestras recibidas con su paciente y orden de laboratorio"""
+    pool = Pool()
+    Party = pool.get('party.party')
+    Patient = pool.get('gnuhealth.patient')
+    TestType = pool.get('gnuhealth.lab.test_type')
+    Lab = pool.get('gnuhealth.lab')
+    Sample = pool.get('gnuhealth.lab.workflow.sample')
+
+    number = next(_numbers)
+    test_type, = TestType.create([{
+                'name': 'Workflow Test %s' % number,
+                'code': 'WFT%s' % number,
+                }])
+    parties = Party.create([{
+                'name': 'Test Patient %s' % i,
+                'is_person': True,
+                'is_patient': True,
+                } for i in range(quantity)])
+    patients = Patient.create([{'name': p.id} for p in parties])
+    orders = [next(_numbers) for _ in patients]
+    labs = Lab.create([{
+                'name': 'LAB%s' % order,
+                'test': test_type.id,
+                'patient': patient.id,
+                'request_order': order,
+                } for order, patient in zip(orders, patients)])
+    sample_values = {
+        'state': 'received',
+        'collection_date': datetime.now(),
+        'received_date': datetime.now(),
+        }
+    sample_values.update(values)
+    return Sample.create([dict(sample_values,
+                name=str(order), lab_test=lab.id)
+            for order, lab in zip(orders, labs)])
+
+
+def create_molecular(samples, professional, **values):
+    MolecularBiology = Pool().get('gnuhealth.lab.molecular_biology')
+    return MolecularBiology.create([dict({
+                    'workflow_sample': s.id,
+                    'analysis_type': 'qpcr',
+                    'responsible_professional': professional.id,
+                    }, **values) for s in samples])
+
+
+def create_immunoassay(samples, professional, **values):
+    Immunoassay = Pool().get('gnuhealth.lab.immunoassay')
+    return Immunoassay.create([dict({
+                    'workflow_sample': s.id,
+                    'assay_type': 'elisa',
+                    'kit_name': 'Test Kit',
+                    'responsible_professional': professional.id,
+                    }, **values) for s in samples])
+
+
+# Parámetros conocidos (a, b, log c, d[, g]) y concentraciones estándar
+CURVE_4PL = [0.05, 1.3, 2.484906649788, 2.8]
+CURVE_5PL = CURVE_4PL + [0.7]
+STANDARDS = [0.5, 1., 2., 5., 10., 20., 50., 100.]
+
+
+def create_plate(standards, params, five=False, **values):
+    "Placa con pocillos estándar leídos sobre la curva de parámetros dados"
+    Plate = Pool().get('gnuhealth.lab.immunoassay.plate')
+    signals = logistic(np.array(standards), np.array(params), five)
+    plate_values = {
+        'name': 'Plate %s' % next(_numbers),
+        'analyte': 'Test Antigen',
+        'curve_model': '5pl' if five else '4pl',
+        'wells': [('create', [{
+                            'well': 'S%s' % i,
+                            'role': 'standard',
+                            'nominal_concentration': standard,
+                            'signal': float(signal),
+                            } for i, (standard, signal) in enumerate(
+                            zip(standards, signals), 1)])],
+        }
+    plate_values.update(values)
+    plate, = Plate.create([plate_values])
+    return plate
+
+
+class HealthLabWorkflowTestCase(ModuleTestCase):
+    'Test Health Lab Workflow module'
+    module = 'health_lab_workflow'
+
+    @with_transaction()
+    def test_sample_read_query_budget(self):
+        "Reading 100 samples with their function fields takes ≤ 5 queries"
+        Sample = Pool().get('gnuhealth.lab.workflow.sample')
+        professional = create_professional()
+        samples = create_samples(100)
+        create_molecular(samples[::2], professional)
+        fields_names = ['name', 'patient', 'lab_test_id', 'sample_type',
+            'state', 'all_processes_completed', 'active_process_count',
+            'total_process_count']
+        ids = [s.id for s in samples]
+        # Calentar las cachés de reglas y accesos
+        Sample.read(ids[:1], fields_names)
+
+        with assert_query_budget(5):
+            rows = Sample.read(ids, fields_names)
+        self.assertEqual(len(rows), 100)
+        self.assertTrue(all(r['patient'] for r in rows))
+        self.assertTrue(all(r['lab_test_id'] for r in rows))
+
+    @with_transaction()
+    def test_process_sample_info_query_budget(self):
+        "The sample info of 100 processes is read with one query per slice"
+        MolecularBiology = Pool().get('gnuhealth.lab.molecular_biology')
+        professional = create_professional()
+        samples = create_samples(100)
+        processes = create_molecular(samples, professional)
+        ids = [p.id for p in processes]
+        fields_names = ['name', 'patient', 'sample_type']
+        MolecularBiology.read(ids[:1], fields_names)
+
+        with assert_query_budget(3):
+            rows = MolecularBiology.read(ids, fields_names)
+        self.assertEqual(
+            {r['name'] for r in rows}, {s.name for s in samples})
+        self.assertEqual({r['sample_type'] for r in rows}, {'Blood'})
+
+    @with_transaction()
+    def test_all_processes_completed_query_budget(self):
+        "Searching samples ready to complete is a single query"
+        Sample = Pool().get('gnuhealth.lab.workflow.sample')
+        professional = create_professional()
+        samples = create_samples(20)
+        create_molecular(samples, professional)
+        Sample.search([('all_processes_completed', '=', True)])
+
+        with assert_query_budget(2):
+            ready = Sample.search([('all_processes_completed', '=', True)])
+        self.assertEqual(ready, [])
+
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_fit_logistic_4pl(self):
+        "The fitter recovers known 4PL parameters"
+        x = np.array(STANDARDS)
+        y = logistic(x, np.array(CURVE_4PL))
+        params, r_squared = fit_logistic(x, y)
+        np.testing.assert_allclose(params, CURVE_4PL, rtol=1e-4)
+        self.assertAlmostEqual(r_squared, 1., places=6)
+        np.testing.assert_allclose(
+            inverse_logistic(logistic(np.array([3., 30.]), params),
+                params), [3., 30.], rtol=1e-4)
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_fit_logistic_5pl(self):
+        "The fitter recovers known 5PL parameters"
+        x = np.array(STANDARDS)
+        y = logistic(x, np.array(CURVE_5PL), five=True)
+        params, r_squared = fit_logistic(x, y, five=True)
+        np.testing.assert_allclose(params, CURVE_5PL, rtol=1e-4)
+        self.assertAlmostEqual(r_squared, 1., places=6)
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    @with_transaction()
+    def test_plate_4pl_needs_five_standards(self):
+        "Computing a 4PL plate with fewer than 5 standards fails"
+        Plate = Pool().get('gnuhealth.lab.immunoassay.plate')
+        plate = create_plate(STANDARDS[:4], CURVE_4PL)
+
+        with self.assertRaises(UserError):
+            Plate.compute([plate])
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    @with_transaction()
+    def test_plate_5pl_needs_six_standards(self):
+        "Computing a 5PL plate with fewer than 6 standards fails"
+        Plate = Pool().get('gnuhealth.lab.immunoassay.plate')
+        plate = create_plate(STANDARDS[:5], CURVE_5PL, five=True)
+
+        with self.assertRaises(UserError):
+            Plate.compute([plate])
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    @with_transaction()
+    def test_plate_controls_without_cutoff(self):
+        "Controls are evaluated against the standards without a cutoff"
+        pool = Pool()
+        Plate = pool.get('gnuhealth.lab.immunoassay.plate')
+        Well = pool.get('gnuhealth.lab.immunoassay.plate.well')
+        Immunoassay = pool.get('gnuhealth.lab.immunoassay')
+        professional = create_professional()
+        immunoassay, = create_immunoassay(create_samples(1), professional)
+        plate = create_plate(STANDARDS, CURVE_4PL)
+        signals = logistic(np.array([8., 30.]), np.array(CURVE_4PL))
+        Well.create([{
+                    'plate': plate.id,
+                    'well': 'A1',
+                    'role': 'sample',
+                    'immunoassay': immunoassay.id,
+                    'signal': float(signals[0]),
+                    }, {
+                    'plate': plate.id,
+                    'well': 'P1',
+                    'role': 'positive_control',
+                    'signal': float(signals[1]),
+                    }, {
+                    'plate': plate.id,
+                    'well': 'N1',
+                    'role': 'negative_control',
+                    'signal': 0.02,
+                    }])
+
+        Plate.compute([plate])
+
+        plate = Plate(plate.id)
+        immunoassay = Immunoassay(immunoassay.id)
+        self.assertEqual(plate.state, 'computed')
+        self.assertEqual(immunoassay.positive_control, 'pass')
+        self.assertEqual(immunoassay.negative_control, 'pass')
+        antibody, = immunoassay.antibodies
+        self.assertAlmostEqual(antibody.quantitative_result, 8., places=3)
+        self.assertIsNone(antibody.qualitative_result)
+
+
+    @with_transaction()
+    def test_import_plate_sniffs_delimiter(self):
+        "A semicolon plate export with decimal commas is imported"
+        Antibody = Pool().get('gnuhealth.lab.immunoassay.antibody')
+        professional = create_professional()
+        sample, = create_samples(1)
+        immunoassay, = create_immunoassay([sample], professional)
+        data = ('Well;Sample;Analyte;Value\r\n'
+            'A01;%s;HBsAg;1,25\r\n' % sample.name).encode('utf-8')
+
+        report = Antibody.import_plate(data, cutoff=1.)
+
+        self.assertEqual(report['errors'], [])
+        antibody, = report['created']
+        self.assertEqual(antibody.immunoassay, immunoassay)
+        self.assertEqual(antibody.name, 'HBsAg')
+        self.assertEqual(antibody.quantitative_result, 1.25)
+        self.assertEqual(antibody.qualitative_result, 'positive')
+        self.assertEqual(antibody.observations, 'Well A1')
+
+    @with_transaction()
+    def test_import_plate_reports_malformed_rows(self):
+        "Malformed plate rows are reported with their line number"
+        Antibody = Pool().get('gnuhealth.lab.immunoassay.antibody')
+        professional = create_professional()
+        sample, = create_samples(1)
+        create_immunoassay([sample], professional)
+        data = '\n'.join([
+                'Well,Sample,Value',
+                'A1,%s,0.8' % sample.name,
+                'Z99,%s,0.8' % sample.name,
+                'A2,%s,abc' % sample.name,
+                'A3,,0.8',
+                'A4,%s,' % sample.name,
+                'A5,999999999,0.8',
+                ]).encode('utf-8')
+
+        report = Antibody.import_plate(data, name='HBsAg')
+
+        self.assertEqual(len(report['created']), 1)
+        self.assertEqual([line for line, _ in report['errors']],
+            [3, 4, 5, 6, 7])
+
+    @with_transaction()
+    def test_import_plate_ambiguous_process(self):
+        "Rows of a sample with several active immunoassays are errors"
+        Antibody = Pool().get('gnuhealth.lab.immunoassay.antibody')
+        professional = create_professional()
+        sample, = create_samples(1)
+        create_immunoassay([sample], professional)
+        with Transaction().set_context(_skip_warnings=True):
+            create_immunoassay([sample], professional)
+        data = ('Well,Sample,Analyte,Value\n'
+            'A1,%s,HBsAg,0.8\n' % sample.name).encode('utf-8')
+
+        report = Antibody.import_plate(data)
+
+        self.assertEqual(report['created'], [])
+        (line, message), = report['errors']
+        self.assertEqual(line, 2)
+        self.assertIn('Several active immunoassays', message)
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    @with_transaction()
+    def test_import_qpcr_run(self):
+        "A thermocycler export with extra header lines is interpreted"
+        pool = Pool()
+        Marker = pool.get('gnuhealth.lab.molecular_biology.antibody')
+        CtRule = pool.get('gnuhealth.lab.molecular_biology.ct_rule')
+        professional = create_professional()
+        sample, = create_samples(1)
+        process, = create_molecular([sample], professional)
+        CtRule.create([{'target': 'N1', 'cutoff': 35.}])
+        data = '\n'.join([
+                '* Block Type = 96-Well Block',
+                '* Experiment Name = Run 1',
+                '',
+                'Well\tSample Name\tTarget Name\tCT',
+                'A1\t%s\tN1\t24,5' % sample.name,
+                'A2\t%s\tN1\t23.9' % sample.name,
+                'A3\t%s\tRP\tUndetermined' % sample.name,
+                'A4\t%s\tN1\tabc' % sample.name,
+                'A5\t\tN1\t20.0',
+                ]).encode('utf-8')
+
+        report = Marker.import_qpcr_run(data)
+
+        self.assertEqual([line for line, _ in report['errors']], [8, 9])
+        markers = {m.name: m for m in report['interpreted']}
+        self.assertEqual(set(markers), {'N1', 'RP'})
+        # Réplicas: se conserva el menor Ct
+        self.assertEqual(markers['N1'].ct_value, 23.9)
+        self.assertEqual(markers['N1'].result, 'amplified')
+        self.assertEqual(markers['N1'].molecular_biology, process)
+        self.assertIsNone(markers['RP'].ct_value)
+        self.assertEqual(markers['RP'].result, 'not_amplified')
+
+    @with_transaction()
+    def test_import_qpcr_run_ambiguous_process(self):
+        "Ct of a sample with several active processes are errors"
+        Marker = Pool().get('gnuhealth.lab.molecular_biology.antibody')
+        professional = create_professional()
+        sample, = create_samples(1)
+        create_molecular([sample], professional)
+        with Transaction().set_context(_skip_warnings=True):
+            create_molecular([sample], professional)
+        data = ('Sample Name,Target Name,Ct\n'
+            '%s,N1,24.5\n' % sample.name).encode('utf-8')
+
+        report = Marker.import_qpcr_run(data)
+
+        self.assertEqual(report['interpreted'], [])
+        (line, message), = report['errors']
+        self.assertEqual(line, 2)
+        self.assertIn('Several active molecular biology processes',
+            message)
+
+
+    @with_transaction()
+    def test_generate_lab_reports_records_failures(self):
+        "Samples whose report fails are recorded and not retried"
+        Sample = Pool().get('gnuhealth.lab.workflow.sample')
+        sample, = create_samples(1, state='completed')
+
+        Sample.generate_lab_reports()
+
+        sample = Sample(sample.id)
+        self.assertIn('original lab test request', sample.lab_report_error)
+        with patch.object(Sample, 'create_lab_reports',
+                return_value=[]) as create_lab_reports:
+            Sample.generate_lab_reports()
+        create_lab_reports.assert_not_called()
+
+
+    @with_transaction()
+    def test_search_all_processes_completed(self):
+        "Searching all_processes_completed with =, !=, in and not in"
+        Sample = Pool().get('gnuhealth.lab.workflow.sample')
+        professional = create_professional()
+        done, active, empty = create_samples(3)
+        create_molecular([done], professional, state='completed')
+        create_molecular([active], professional)
+        ids = [done.id, active.id, empty.id]
+
+        def search(operator, value):
+            return set(Sample.search([
+                        ('id', 'in', ids),
+                        ('all_processes_completed', operator, value),
+                        ]))
+
+        self.assertEqual(search('=', True), {done})
+        self.assertEqual(search('=', False), {active, empty})
+        self.assertEqual(search('!=', True), {active, empty})
+        self.assertEqual(search('!=', False), {done})
+        self.assertEqual(search('in', [True]), {done})
+        self.assertEqual(search('in', [True, False]), {done, active, empty})
+        self.assertEqual(search('in', []), set())
+        self.assertEqual(search('not in', [True]), {active, empty})
+        self.assertEqual(search('not in', [True, False]), set())
+        self.assertEqual(search('not in', []), {done, active, empty})
+
+
+    @with_transaction()
+    def test_sample_state_latest_sample(self):
+        "sample_state follows the latest sample of each lab order"
+        pool = Pool()
+        Lab = pool.get('gnuhealth.lab')
+        Sample = pool.get('gnuhealth.lab.workflow.sample')
+        sample, removed = create_samples(2)
+        lab, empty = sample.lab_test, removed.lab_test
+        Sample.create([{
+                    'name': str(next(_numbers)),
+                    'lab_test': lab.id,
+                    'state': 'processing',
+                    }])
+        Sample.delete([removed])
+        ids = [lab.id, empty.id]
+
+        def search(operator, value):
+            return set(Lab.search([
+                        ('id', 'in', ids),
+                        ('sample_state', operator, value),
+                        ]))
+
+        self.assertEqual(
+            {l.id: l.sample_state for l in Lab.browse(ids)},
+            {lab.id: 'processing', empty.id: 'no_sample'})
+        self.assertEqual(search('=', 'processing'), {lab})
+        self.assertEqual(search('=', 'received'), set())
+        self.assertEqual(search('=', 'no_sample'), {empty})
+        self.assertEqual(search('!=', 'no_sample'), {lab})
+        self.assertEqual(
+            search('in', ['processing', 'no_sample']), {lab, empty})
+        self.assertEqual(search('not in', ['processing']), {empty})
+
+
+    @with_transaction()
+    def test_turnaround_percentiles(self):
+        "The turnaround report computes percentiles on every backend"
+        pool = Pool()
+        Transition = pool.get('gnuhealth.lab.workflow.transition')
+        Turnaround = pool.get('gnuhealth.lab.workflow.turnaround')
+        professional = create_professional()
+        processes = create_molecular(create_samples(10), professional)
+        # Duraciones de 1 a 10 horas completadas ayer
+        yesterday = date.today() - timedelta(days=1)
+        start = datetime.combine(yesterday, time())
+        table = Transition.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.insert(
+                [table.create_uid, table.create_date, table.date,
+                    table.specialty, table.record, table.sample,
+                    table.from_state, table.to_state],
+                [[0, start, when, 'molecular_biology', p.id,
+                        p.workflow_sample.id, from_state, to_state]
+                    for hours, p in enumerate(processes, 1)
+                    for when, from_state, to_state in [
+                        (start, None, 'draft'),
+                        (start + timedelta(hours=hours), 'in_progress',
+                            'completed'),
+                        ]]))
+
+        with Transaction().set_context(
+                from_date=yesterday, to_date=yesterday):
+            row, = Turnaround.search([])
+        self.assertEqual(row.date, yesterday)
+        self.assertEqual(row.specialty, 'molecular_biology')
+        self.assertEqual(row.count, 10)
+        if backend.name == 'postgresql':
+            # Percentiles continuos
+            expected = [5.5, 9.1, 9.91]
+        else:
+            # Percentiles por rango más cercano
+            expected = [5., 9., 10.]
+        for value, percentile in zip(expected, [row.p50, row.p90, row.p99]):
+            self.assertAlmostEqual(percentile, value, places=2)
+
+
+    @with_transaction()
+    def test_write_stage_keeps_existing_dates(self):
+        "Stage buttons only fill the dates that are still empty"
+        Histopathology = Pool().get('gnuhealth.lab.histopathology')
+        professional = create_professional()
+        filled = datetime(2020, 1, 1, 8, 0)
+        tests = Histopathology.create([{
+                    'workflow_sample': s.id,
+                    'study_type': 'routine',
+                    'responsible_professional': professional.id,
+                    'state': 'processing',
+                    'inclusion_date': inclusion,
+                    } for s, inclusion in zip(
+                    create_samples(2), [filled, None])])
+
+        Histopathology.complete_processing(tests)
+
+        kept, set_now = Histopathology.browse([t.id for t in tests])
+        self.assertEqual([kept.state, set_now.state], ['cutting', 'cutting'])
+        self.assertEqual(kept.inclusion_date, filled)
+        self.assertGreater(set_now.inclusion_date, filled)
+
+
+    @with_transaction()
+    def test_has_active_process_in_batch(self):
+        "Duplicate active processes inside one create batch are detected"
+        pool = Pool()
+        Sample = pool.get('gnuhealth.lab.workflow.sample')
+        MolecularBiology = pool.get('gnuhealth.lab.molecular_biology')
+        professional = create_professional()
+        sample, other = create_samples(2)
+
+        self.assertTrue(Sample.has_active_process(MolecularBiology, [
+                    {'workflow_sample': sample.id},
+                    {'workflow_sample': sample.id},
+                    ]))
+        self.assertFalse(Sample.has_active_process(MolecularBiology, [
+                    {'workflow_sample': sample.id},
+                    {'workflow_sample': sample.id, 'state': 'cancelled'},
+                    {'workflow_sample': other.id},
+                    ]))
+        with self.assertRaises(UserWarning):
+            create_molecular([sample, sample], professional)
+
+        create_molecular([sample], professional)
+        self.assertTrue(Sample.has_active_process(MolecularBiology, [
+                    {'workflow_sample': sample.id},
+                    ]))
+        self.assertFalse(Sample.has_active_process(MolecularBiology, [
+                    {'workflow_sample': other.id},
+                    ]))
+
+
+del ModuleTestCase
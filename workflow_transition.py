@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+from sql import Cast, Literal, Window
+from sql.aggregate import Aggregate, Count, Max, Min
+from sql.conditionals import Case
+from sql.functions import CurrentTimestamp, Extract, Function, RowNumber
+
+from trytond import backend
+from trytond.i18n import gettext
+from trytond.model import ModelView, ModelSQL, Index, fields
+from trytond.model.exceptions import AccessError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .health_lab_workflow import SAMPLE_TYPES
+
+__all__ = ['GnuHealthLabWorkflowTransition', 'GnuHealthLabTurnaroundContext',
+           'GnuHealthLabTurnaround']
+
+# Origen de cada transición: la muestra o una de las especialidades
+SPECIALTIES = [
+    ('sample', 'Sample'),
+    ('molecular_biology', 'Molecular Biology'),
+    ('histopathology', 'Histopathology'),
+    ('immunoassay', 'Immunoassay'),
+]
+
+
+class PercentileCont(Aggregate):
+    'PERCENTILE_CONT(fraction) WITHIN GROUP (ORDER BY ...) de PostgreSQL'
+    __slots__ = ()
+    _sql = 'PERCENTILE_CONT'
+
+
+class JulianDay(Function):
+    'JULIANDAY(fecha) de SQLite'
+    __slots__ = ()
+    _function = 'JULIANDAY'
+
+
+class SQLiteDate(Function):
+    'DATE(fecha) de SQLite'
+    __slots__ = ()
+    _function = 'DATE'
+
+
+class GnuHealthLabWorkflowTransition(ModelSQL, ModelView):
+    'Lab Workflow State Transition'
+    __name__ = 'gnuhealth.lab.workflow.transition'
+
+    date = fields.DateTime('Date', required=True, readonly=True)
+
+    specialty = fields.Selection(SPECIALTIES, 'Specialty', required=True,
+        readonly=True)
+
+    # Id del registro que cambió de estado (muestra o proceso)
+    record = fields.Integer('Record', required=True, readonly=True)
+
+    sample = fields.Many2One('gnuhealth.lab.workflow.sample',
+        'Workflow Sample', required=True, readonly=True, ondelete='CASCADE')
+
+    from_state = fields.Char('From State', readonly=True)
+    to_state = fields.Char('To State', required=True, readonly=True)
+
+    user = fields.Many2One('res.user', 'User', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(GnuHealthLabWorkflowTransition, cls).__setup__()
+        cls._order = [('date', 'DESC'), ('id', 'DESC')]
+        t = cls.__table__()
+        cls._sql_indexes.update({
+            Index(t, (t.date, Index.Range())),
+            Index(t, (t.sample, Index.Range())),
+            Index(t,
+                (t.specialty, Index.Equality()),
+                (t.record, Index.Range()),
+                (t.date, Index.Range())),
+            Index(t,
+                (t.to_state, Index.Equality()),
+                (t.date, Index.Range())),
+        })
+
+    @classmethod
+    def changes(cls, specialty, args):
+        """Transiciones de estado que producirá una llamada a write(*args);
+        se leen antes de escribir y se guardan después con log()"""
+        rows = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            to_state = values.get('state')
+            if not to_state:
+                continue
+            for record in records:
+                if record.state == to_state:
+                    continue
+                sample = (record if specialty == 'sample'
+                    else record.workflow_sample)
+                rows.append(
+                    (specialty, record.id, sample.id, record.state, to_state))
+        return rows
+
+    @classmethod
+    def creations(cls, specialty, records):
+        """Transiciones de alta (sin estado previo) de registros nuevos"""
+        return [(specialty, r.id,
+                r.id if specialty == 'sample' else r.workflow_sample.id,
+                None, r.state) for r in records]
+
+    @classmethod
+    def log(cls, rows):
+        """Guarda las transiciones con un único INSERT"""
+        if not rows:
+            return
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        now = datetime.now()
+        user = transaction.user
+        cursor.execute(*table.insert(
+                [table.create_uid, table.create_date, table.date,
+                    table.specialty, table.record, table.sample,
+                    table.from_state, table.to_state, table.user],
+                [[user, now, now, specialty, record, sample, from_state,
+                        to_state, user]
+                    for specialty, record, sample, from_state, to_state
+                    in rows]))
+
+    @classmethod
+    def write(cls, *args):
+        # Solo se rechazan las llamadas de los clientes; el servidor
+        # (p. ej. el borrado en cascada de la muestra) sigue funcionando
+        if Transaction().check_access:
+            raise AccessError(gettext(
+                    'health_lab_workflow.msg_workflow_transition_readonly'))
+        super(GnuHealthLabWorkflowTransition, cls).write(*args)
+
+    @classmethod
+    def delete(cls, transitions):
+        if Transaction().check_access:
+            raise AccessError(gettext(
+                    'health_lab_workflow.msg_workflow_transition_readonly'))
+        super(GnuHealthLabWorkflowTransition, cls).delete(transitions)
+
+
+class GnuHealthLabTurnaroundContext(ModelView):
+    'Lab Turnaround Time Context'
+    __name__ = 'gnuhealth.lab.workflow.turnaround.context'
+
+    from_date = fields.Date('From Date', required=True)
+    to_date = fields.Date('To Date', required=True)
+
+    @staticmethod
+    def default_from_date():
+        return datetime.now().date() - timedelta(days=30)
+
+    @staticmethod
+    def default_to_date():
+        return datetime.now().date()
+
+
+class GnuHealthLabTurnaround(ModelSQL, ModelView):
+    'Lab Turnaround Time'
+    __name__ = 'gnuhealth.lab.workflow.turnaround'
+
+    date = fields.Date('Date', readonly=True,
+        help='Day the samples or processes were completed')
+    specialty = fields.Selection(SPECIALTIES, 'Specialty', readonly=True)
+    sample_type = fields.Selection(SAMPLE_TYPES, 'Sample Type', readonly=True)
+    origin_institution = fields.Many2One('gnuhealth.institution',
+        'Origin Institution', readonly=True)
+
+    count = fields.Integer('Completed', readonly=True)
+    p50 = fields.Float('TAT p50 (h)', digits=(16, 2), readonly=True,
+        help='Median turnaround time in hours')
+    p90 = fields.Float('TAT p90 (h)', digits=(16, 2), readonly=True)
+    p99 = fields.Float('TAT p99 (h)', digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(GnuHealthLabTurnaround, cls).__setup__()
+        cls._order = [('date', 'DESC'), ('specialty', 'ASC')]
+
+    @classmethod
+    def table_query(cls):
+        """Tiempos de respuesta desde el alta hasta la finalización, por día,
+        especialidad, tipo de muestra e institución (percentiles continuos en
+        PostgreSQL y por rango más cercano en SQLite)"""
+        pool = Pool()
+        Transition = pool.get('gnuhealth.lab.workflow.transition')
+        Sample = pool.get('gnuhealth.lab.workflow.sample')
+        context = Transaction().context
+        log = Transition.__table__()
+        first = Transition.__table__()
+        sample = Sample.__table__()
+
+        # Registros completados en el período (índice to_state, date)
+        where = log.to_state == 'completed'
+        if context.get('from_date'):
+            where &= log.date >= datetime.combine(
+                context['from_date'], datetime.min.time())
+        if context.get('to_date'):
+            where &= log.date < datetime.combine(
+                context['to_date'] + timedelta(days=1), datetime.min.time())
+        done = log.select(
+            Min(log.id).as_('id'), log.specialty, log.record, log.sample,
+            Max(log.date).as_('end'),
+            where=where,
+            group_by=[log.specialty, log.record, log.sample])
+
+        # Primera transición de cada registro (índice specialty, record)
+        durations = done.join(first,
+            condition=(first.specialty == done.specialty)
+            & (first.record == done.record)
+            ).select(
+            done.id, done.specialty, done.sample, done.end,
+            Min(first.date).as_('start'),
+            group_by=[done.id, done.specialty, done.sample, done.end])
+
+        postgresql = backend.name == 'postgresql'
+        if postgresql:
+            hours = Extract('EPOCH', durations.end - durations.start) / 3600
+            day = Cast(durations.end, 'DATE')
+        else:
+            hours = (JulianDay(durations.end)
+                - JulianDay(durations.start)) * 24
+            day = SQLiteDate(durations.end)
+        keys = [day, durations.specialty, sample.sample_type,
+            sample.origin_institution]
+        columns = [durations.id, day.as_('date'), durations.specialty,
+            sample.sample_type, sample.origin_institution,
+            hours.as_('hours')]
+        if not postgresql:
+            # Sin PERCENTILE_CONT: percentil por rango más cercano con la
+            # posición de cada duración dentro de su grupo
+            columns += [
+                RowNumber(window=Window(keys, order_by=[hours])).as_('rank'),
+                Count(Literal('*'), window=Window(keys)).as_('size'),
+                ]
+        rows = durations.join(sample,
+            condition=durations.sample == sample.id
+            ).select(*columns)
+
+        def percentile(fraction):
+            if postgresql:
+                return PercentileCont(Literal(fraction), within=rows.hours)
+            return Min(Case((rows.rank >= rows.size * fraction, rows.hours)))
+
+        return rows.select(
+            Min(rows.id).as_('id'),
+            Literal(0).as_('create_uid'),
+            CurrentTimestamp().as_('create_date'),
+            Literal(None).as_('write_uid'),
+            Literal(None).as_('write_date'),
+            rows.date,
+            rows.specialty,
+            rows.sample_type,
+            rows.origin_institution,
+            Count(Literal('*')).as_('count'),
+            percentile(0.5).as_('p50'),
+            percentile(0.9).as_('p90'),
+            percentile(0.99).as_('p99'),
+            group_by=[rows.date, rows.specialty, rows.sample_type,
+                rows.origin_institution])
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+from sql import Cast, Literal, Union
+from sql.operators import Concat
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+
+from .health_lab_workflow import (SAMPLE_TYPES, PROCESS_MODELS,
+    PROCESS_CLOSED_STATES)
+
+__all__ = ['GnuHealthLabWorklist']
+
+# Estados abiertos de las tres especialidades
+WORKLIST_STATES = [
+    ('draft', 'Draft'),
+    ('processing', 'Processing'),
+    ('in_progress', 'In Progress'),
+    ('macroscopy', 'Macroscopy'),
+    ('cutting', 'Cutting'),
+    ('staining', 'Staining'),
+]
+
+
+class GnuHealthLabWorklist(ModelSQL, ModelView):
+    'Lab Worklist'
+    __name__ = 'gnuhealth.lab.workflow.worklist'
+    
+    process = fields.Reference('Process', [
+            ('gnuhealth.lab.molecular_biology', 'Molecular Biology'),
+            ('gnuhealth.lab.histopathology', 'Histopathology'),
+            ('gnuhealth.lab.immunoassay', 'Immunoassay'),
+            ], readonly=True)
+    specialty = fields.Selection([
+            ('molecular_biology', 'Molecular Biology'),
+            ('histopathology', 'Histopathology'),
+            ('immunoassay', 'Immunoassay'),
+            ], 'Specialty', readonly=True)
+    workflow_sample = fields.Many2One('gnuhealth.lab.workflow.sample',
+        'Workflow Sample', readonly=True)
+    name = fields.Char('Order Number', readonly=True)
+    patient = fields.Many2One('gnuhealth.patient', 'Patient', readonly=True)
+    sample_type = fields.Selection(SAMPLE_TYPES, 'Sample Type', readonly=True)
+    state = fields.Selection(WORKLIST_STATES, 'State', readonly=True)
+    responsible_professional = fields.Many2One('gnuhealth.healthprofessional',
+        'Responsible Professional', readonly=True)
+    start_date = fields.DateTime('Start Date', readonly=True)
+    age = fields.Function(fields.Float('Age (h)', digits=(16, 1),
+            help='Hours since the process was created'), 'get_age')
+    
+    @classmethod
+    def __setup__(cls):
+        super(GnuHealthLabWorklist, cls).__setup__()
+        # Los más antiguos primero
+        cls._order = [('start_date', 'ASC'), ('id', 'ASC')]
+    
+    @classmethod
+    def get_age(cls, records, name):
+        """Horas desde el alta, calculadas aquí para no depender de la
+        aritmética de fechas de cada base de datos"""
+        now = datetime.now()
+        return {r.id: (now - r.start_date).total_seconds() / 3600
+            if r.start_date else None for r in records}
+    
+    @classmethod
+    def table_query(cls):
+        """Procesos abiertos de las tres especialidades en un solo UNION ALL;
+        el id se codifica como id * 3 + posición de la especialidad"""
+        pool = Pool()
+        Sample = pool.get('gnuhealth.lab.workflow.sample')
+        Lab = pool.get('gnuhealth.lab')
+        
+        queries = []
+        for offset, (specialty, model_name) in enumerate(PROCESS_MODELS):
+            process = pool.get(model_name).__table__()
+            sample = Sample.__table__()
+            lab = Lab.__table__()
+            queries.append(process.join(sample,
+                    condition=process.workflow_sample == sample.id
+                    ).join(lab, 'LEFT',
+                    condition=sample.lab_test == lab.id
+                    ).select(
+                    (process.id * len(PROCESS_MODELS) + offset).as_('id'),
+                    process.create_uid,
+                    process.create_date,
+                    process.write_uid,
+                    process.write_date,
+                    Concat(model_name + ',',
+                        Cast(process.id, 'VARCHAR')).as_('process'),
+                    Literal(specialty).as_('specialty'),
+                    process.workflow_sample,
+                    sample.name,
+                    lab.patient,
+                    sample.sample_type,
+                    process.state,
+                    process.responsible_professional,
+                    process.create_date.as_('start_date'),
+                    where=~process.state.in_(PROCESS_CLOSED_STATES)))
+        return Union(*queries, all_=True)